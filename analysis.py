@@ -0,0 +1,91 @@
+import main as mainmodule
+import argparse
+import collections
+import copy
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+
+# The pristine (bundle, has_dlc, data, loot) of a worker process, randomize copies of it for every seed.
+_state = None
+
+
+def _loot(bundle, data: mainmodule.GameData) -> list:
+    # The mission type and the items of every MasterLoot, in the same order randomize_loot visits them.
+    result = []
+    for encounter in bundle.getNodes("Encounter"):
+        master_loot = encounter.subNode("MasterLoot")
+        if master_loot:
+            result.append((data.encounters.getMissionType(encounter), [data.items.find(child.text) for child in master_loot]))
+    return result
+
+
+def _init_worker(install_path: str) -> None:
+    global _state
+    bundle, has_dlc = mainmodule.load_bundle(install_path)
+    data = mainmodule.load_game_data(bundle, has_dlc)
+    _state = (bundle, has_dlc, data, _loot(bundle, data))
+
+
+def collect(bundle, data: mainmodule.GameData, loot: list, stats: Dict[str, collections.Counter]) -> None:
+    """Adds the outcome of a randomized bundle to the histograms in stats, loot is the _loot of the pristine bundle."""
+    for (mission_type, originals), (_, items) in zip(loot, _loot(bundle, data)):
+        for original, item in zip(originals, items):
+            if original is None or item is None:
+                continue
+            if mission_type == "heist":
+                stats["heist_tier_shift"][item.tier - original.tier] += 1
+                stats["heist_same_type"][item.rtype == original.rtype] += 1
+            elif mission_type == "bar":
+                stats["shop_rarity"]["%d/%s" % (item.tier, item.rtype)] += 1
+
+    main_perks = mainmodule.MAIN_PERKS + (mainmodule.DLC_MAIN_PERKS if data.has_dlc else [])
+    for cast in mainmodule.CAST + (mainmodule.DLC_CAST if data.has_dlc else []):
+        starting = bundle.queryOne("Persona[Name=%s]/LevelCategories/Levels[@Type=starting]" % (cast))
+        weapons = sorted(level.attr("Perk") for level in starting if level.attr("Perk") in mainmodule.WEAPON_PERKS)
+        stats["weapons/%s" % (cast)]["+".join(weapons)] += 1
+        upgrades = {level.attr("Perk") for level in bundle.queryOne("Persona[Name=%s]/LevelCategories/Levels[@Type=upgrades]" % (cast))}
+        complete = partial = 0
+        for chain in main_perks:
+            count = sum(1 for perk in chain if perk in upgrades)
+            if count == len(chain):
+                complete += 1
+            elif count:
+                partial += 1
+        stats["complete_chains/%s" % (cast)][complete] += 1
+        stats["partial_chains/%s" % (cast)][partial] += 1
+
+
+def _analyze_seeds(conf: argparse.Namespace, seeds: List[str]) -> Dict[str, collections.Counter]:
+    bundle, has_dlc, data, loot = _state
+    stats = collections.defaultdict(collections.Counter)
+    for seed in seeds:
+        seed_conf = copy.copy(conf)
+        seed_conf.seed = seed
+        randomized = bundle.fork()
+        mainmodule.randomize(randomized, seed_conf, has_dlc, data=data)
+        collect(randomized, data, loot, stats)
+    return stats
+
+
+def run(conf: argparse.Namespace, count: int, out_filename: str, jobs: Optional[int] = None) -> None:
+    """Randomizes count seeds in memory with the options in conf and writes histograms of the results to out_filename.
+
+    The seeds are conf.seed followed by -0, -1, ..., and are split over jobs processes that each parse the game once.
+    """
+    seeds = ["%s-%d" % (conf.seed, n) for n in range(count)]
+    shard_size = max(1, len(seeds) // ((jobs or os.cpu_count() or 1) * 4))
+    stats = collections.defaultdict(collections.Counter)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(conf.install_path,)) as executor:
+        futures = [executor.submit(_analyze_seeds, conf, seeds[n:n + shard_size]) for n in range(0, len(seeds), shard_size)]
+        for future in futures:
+            for name, counter in future.result().items():
+                stats[name].update(counter)
+    with open(out_filename, "wt") as f:
+        json.dump({
+            "seeds": count,
+            "options": {key: getattr(conf, key) for key in ("stripquests", "charweapon", "charlevelup", "epicswag", "shop")},
+            "histograms": {name: {str(key): value for key, value in sorted(counter.items())} for name, counter in sorted(stats.items())},
+        }, f, indent=1)
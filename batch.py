@@ -0,0 +1,54 @@
+import main as mainmodule
+import argparse
+import copy
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+
+# The pristine (bundle, has_dlc, data) of a worker process, loaded once and copied for every seed.
+_pristine = None
+
+
+def seed_directory(seed: str) -> str:
+    # Seeds are free text, keep them usable as a directory name on every platform.
+    name = re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", seed)
+    # Windows drops trailing dots and spaces, and "." or ".." would point outside of the output directory.
+    return re.sub(r"[. ]+$", lambda match: "_" * len(match.group()), name) or "_"
+
+
+def _init_worker(install_path: str) -> None:
+    global _pristine
+    bundle, has_dlc = mainmodule.load_bundle(install_path)
+    _pristine = (bundle, has_dlc, mainmodule.load_game_data(bundle, has_dlc))
+
+
+def _randomize_seed(conf: argparse.Namespace, out_path: str) -> str:
+    bundle, has_dlc, data = _pristine
+    bundle = bundle.fork()
+    mainmodule.randomize(bundle, conf, has_dlc, data=data)
+    bundle.save(out_path, compression=conf.compression)
+    return conf.seed
+
+
+def run(conf: argparse.Namespace, seeds: List[str], out_path: str, jobs: Optional[int] = None) -> None:
+    """Randomizes every seed with the options in conf, writing the files of each seed to out_path/<seed>."""
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(conf.install_path,)) as executor:
+        futures = []
+        used = set()
+        for seed in seeds:
+            # Different seeds can give the same directory name, later ones get a number so nothing is overwritten.
+            # Compared case insensitive, like the file system may do.
+            directory = seed_directory(seed)
+            number = 1
+            while directory.lower() in used:
+                number += 1
+                directory = "%s-%d" % (seed_directory(seed), number)
+            used.add(directory.lower())
+            seed_conf = copy.copy(conf)
+            seed_conf.seed = seed
+            futures.append((directory, executor.submit(_randomize_seed, seed_conf, os.path.join(out_path, directory))))
+        for directory, future in futures:
+            seed = future.result()
+            print("Randomized seed: %s" % (seed) if directory == seed else "Randomized seed: %s into %s" % (seed, directory))
@@ -0,0 +1,259 @@
+"""Benchmarks the randomizer on a synthetic game install, so no real game is needed.
+
+Usage: python benchmark.py [--repeat N] [--output FILE] [fixture size options] [-- randomizer options]
+       python benchmark.py --perk-seeds N
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+from typing import Dict, List
+
+import main as mainmodule
+import incremental
+from impak import cache_filename
+from perks import place_chains
+
+
+def _comment(rnd: random.Random, density: float) -> str:
+    if rnd.random() >= density:
+        return ""
+    if rnd.random() < 0.1:
+        return "<!-- outer <!-- nested comment --> -->\n"
+    return "<!-- %s -->\n" % ("x" * rnd.randint(5, 80))
+
+
+def _persona(rnd: random.Random, name: str, density: float) -> str:
+    starting = "".join('<Level Perk="%s"/>' % perk for perk in ("handgun", "mend"))
+    upgrades = "".join('<Level Perk="%s"/>' % rnd.choice(mainmodule.FILLER_PERKS) for _ in range(10))
+    return ('%s<Persona><Name>%s</Name><LevelCategories><Levels Type="starting">%s</Levels>'
+            '<Levels Type="upgrades">%s</Levels></LevelCategories></Persona>\n' % (_comment(rnd, density), name, starting, upgrades))
+
+
+def _write_impak(filename: str, members: Dict[str, str]) -> None:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+        # The real impaks are mostly textures and sounds, which the randomizer skips.
+        z.writestr("Textures/placeholder.png", bytes(4096))
+
+
+def create_fixture(path: str, *, personas: int = 20, encounters: int = 2000, template_depth: int = 3,
+                   loot: int = 4, items: int = 600, quests: int = 500, other_files: int = 20,
+                   comment_density: float = 0.5, csv_rows: int = 20000, languages: int = 1, dlc: bool = True, seed: int = 0) -> None:
+    """Writes a synthetic install with Bundle/data01.impak, DLC/dlc01/data01.impak and Bundle/Language/en.csv.z plus more languages."""
+    rnd = random.Random(seed)
+    cast = mainmodule.CAST + ["extra_%d" % (n) for n in range(max(0, personas - len(mainmodule.CAST)))]
+    members = {
+        "Definitions/personas.xml": "<Definitions>\n%s</Definitions>" % "".join(_persona(rnd, name, comment_density) for name in cast),
+    }
+
+    names = []
+    for tag in ("Weapon", "Utility"):
+        entries = []
+        for n in range(items // 2):
+            name = "%s_%d" % (tag.lower(), n)
+            names.append(name)
+            entries.append('%s<%s><Name>%s</Name><Rarity Tier="%d" Type="%s"/></%s>\n' % (
+                _comment(rnd, comment_density), tag, name, rnd.randint(1, 5), rnd.choice(["common", "rare", "epic"]), tag))
+        members["Definitions/%ss.xml" % (tag.lower())] = "<Definitions>\n%s</Definitions>" % "".join(entries)
+
+    # Every mission type gets a chain of templates, the encounters use a random step of a chain.
+    entries = []
+    templates = []
+    for mission_type in ("heist", "bar"):
+        entries.append("<Encounter><Name>%s_0</Name><MissionType>%s</MissionType></Encounter>\n" % (mission_type, mission_type))
+        templates.append("%s_0" % (mission_type))
+        for depth in range(1, template_depth):
+            entries.append("<Encounter><Name>%s_%d</Name><Template>%s_%d</Template></Encounter>\n" % (mission_type, depth, mission_type, depth - 1))
+            templates.append("%s_%d" % (mission_type, depth))
+    for n in range(encounters):
+        master_loot = "".join("<Item>%s</Item>" % rnd.choice(names) for _ in range(loot))
+        entries.append("%s<Encounter><Name>encounter_%d</Name><Template>%s</Template><StartConversation>start_%d</StartConversation>"
+                       "<EndConversation>end_%d</EndConversation><MasterLoot>%s</MasterLoot></Encounter>\n" % (
+                           _comment(rnd, comment_density), n, rnd.choice(templates), n, n, master_loot))
+    members["Definitions/encounters.ge"] = "<Definitions>\n%s</Definitions>" % "".join(entries)
+
+    entries = ["<Quest><Name>MAIN</Name></Quest>\n", "<Quest><Name>tutorial_start</Name></Quest>\n"]
+    for n in range(quests):
+        entries.append("%s<Quest><Name>quest_%d</Name><Step>%d</Step></Quest>\n" % (_comment(rnd, comment_density), n, n))
+    members["Definitions/quests.ge"] = "<Definitions>\n%s</Definitions>" % "".join(entries)
+
+    # Files the randomizer never touches, these only cost time when they are parsed anyway.
+    for n in range(other_files):
+        members["Definitions/other_%d.xml" % (n)] = "<Definitions>\n%s</Definitions>" % "".join(
+            "%s<Thing><Name>thing_%d</Name><Value>%d</Value></Thing>\n" % (_comment(rnd, comment_density), m, m) for m in range(200))
+    _write_impak(os.path.join(path, "Bundle", "data01.impak"), members)
+
+    if dlc:
+        # The DLC brings its own crew member and overrides some of the base encounters.
+        entries = [_persona(rnd, name, comment_density) for name in mainmodule.DLC_CAST]
+        for n in range(0, encounters, 10):
+            master_loot = "".join("<Item>%s</Item>" % rnd.choice(names) for _ in range(loot))
+            entries.append("<Encounter><Name>encounter_%d</Name><MasterLoot>%s</MasterLoot></Encounter>\n" % (n, master_loot))
+        _write_impak(os.path.join(path, "DLC", "dlc01", "data01.impak"), {"Definitions/dlc.xml": "<Definitions>\n%s</Definitions>" % "".join(entries)})
+
+    rows = [b"menu_extras\t"] + [b"text_%d\tSome translated text number %d" % (n, n) for n in range(csv_rows)]
+    data = b"\n".join(rows)
+    os.makedirs(os.path.join(path, "Bundle", "Language"), exist_ok=True)
+    for language in ["en"] + ["lang_%d" % (n) for n in range(1, languages)]:
+        with open(os.path.join(path, "Bundle", "Language", "%s.csv.z" % (language)), "wb") as f:
+            f.write(struct.pack("<I", len(data)) + zlib.compress(data, level=9))
+
+
+def _remove_caches(path: str) -> None:
+    for bundle_name in ("Bundle", os.path.join("DLC", "dlc01")):
+        for extension in (".cache", ".index"):
+            cache = cache_filename(os.path.join(path, bundle_name, "data01.impak"), extension)
+            if os.path.exists(cache):
+                os.remove(cache)
+
+
+def run_once(path: str, conf: argparse.Namespace) -> Dict[str, float]:
+    timings = {}
+
+    def timed(name, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[name] = time.perf_counter() - start
+        return result
+
+    _remove_caches(path)
+    timed("load_cold", mainmodule.load_bundle, path)
+    bundle, has_dlc = timed("load_warm", mainmodule.load_bundle, path)
+    timed("clean", bundle.clean)
+    data = timed("game_data", mainmodule.load_game_data, bundle, has_dlc)
+
+    current = [None, 0.0]
+
+    def on_pass(name):
+        now = time.perf_counter()
+        if current[0] is not None:
+            timings["pass_%s" % (current[0])] = now - current[1]
+        current[0], current[1] = name, now
+
+    mainmodule.randomize(bundle, conf, has_dlc, data=data, on_pass=on_pass)
+    on_pass(None)
+    csv = bundle.getCSV("Language/en.csv.z")
+    timed("csv_edit", csv.setMany, {"text_%d" % (n): "Edited %d" % (n) for n in range(0, 20000, 20)})
+    timed("save", bundle.save, compression=conf.compression)
+    bundle.clean()
+
+    # A normal command line run goes through incremental, which journals every change.
+    bundle, has_dlc = mainmodule.load_bundle(path)
+    current = [None, 0.0]
+
+    def mark(name):
+        now = time.perf_counter()
+        if current[0] is not None:
+            timings["incremental_%s" % (current[0])] = now - current[1]
+        current[0], current[1] = name, now
+
+    incremental.run(conf, bundle, has_dlc, on_pass=lambda name: mark("pass_" + name), mark=mark)
+    mark(None)
+    bundle.clean()
+    return timings
+
+
+def stress_perks(seeds: int) -> None:
+    """Checks the basic level up layout for every seed, with and without the DLC chains, and reports the worst time."""
+    for chains in (mainmodule.MAIN_PERKS, mainmodule.MAIN_PERKS + mainmodule.DLC_MAIN_PERKS):
+        worst = 0.0
+        start = time.perf_counter()
+        for seed in range(seeds):
+            rnd = random.Random(seed)
+            step = time.perf_counter()
+            layout = place_chains(rnd, chains)
+            worst = max(worst, time.perf_counter() - step)
+            placed = [perk for perk in layout if perk is not None]
+            assert len(layout) == 10 and len(placed) >= 5, (seed, layout)
+            assert len(set(placed)) == len(placed), (seed, layout)
+            for chain in chains:
+                used = [perk for perk in layout if perk in chain]
+                assert used == [] or used == list(chain), (seed, layout)
+            assert layout == place_chains(random.Random(seed), chains), seed
+        print("%d chains: %d seeds ok in %.2f s, worst %.3f ms" % (len(chains), seeds, time.perf_counter() - start, worst * 1000))
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main(args: List[str]) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the randomizer on a synthetic game install.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="bench_output.json", help="JSON file to write the results to")
+    parser.add_argument("--fixture", help="Directory for the synthetic install, a temporary one by default")
+    parser.add_argument("--personas", type=int, default=20)
+    parser.add_argument("--encounters", type=int, default=2000)
+    parser.add_argument("--template-depth", type=int, default=3)
+    parser.add_argument("--loot", type=int, default=4, help="MasterLoot items per encounter")
+    parser.add_argument("--items", type=int, default=600, help="Number of weapons plus utilities")
+    parser.add_argument("--quests", type=int, default=500)
+    parser.add_argument("--other-files", type=int, default=20)
+    parser.add_argument("--comment-density", type=float, default=0.5)
+    parser.add_argument("--csv-rows", type=int, default=20000)
+    parser.add_argument("--languages", type=int, default=1, help="Number of language tables")
+    parser.add_argument("--no-dlc", action="store_true")
+    parser.add_argument("--perk-seeds", type=int, help="Only stress test the basic level up layout for this many seeds")
+    parser.add_argument("options", nargs=argparse.REMAINDER, help="Randomizer options, after --")
+    bench = parser.parse_args(args)
+    if bench.perk_seeds is not None:
+        stress_perks(bench.perk_seeds)
+        return
+    options = bench.options[1:] if bench.options[:1] == ["--"] else bench.options
+    if not options:
+        options = ["--stripquests", "--charweapon", "wild", "--charlevelup", "wild", "--epicswag", "type", "--shop", "tier"]
+
+    fixture_config = {
+        "personas": bench.personas, "encounters": bench.encounters, "template_depth": bench.template_depth,
+        "loot": bench.loot, "items": bench.items, "quests": bench.quests, "other_files": bench.other_files,
+        "comment_density": bench.comment_density, "csv_rows": bench.csv_rows,
+        "languages": bench.languages, "dlc": not bench.no_dlc,
+    }
+    path = bench.fixture or tempfile.mkdtemp(prefix="heist_bench_")
+    try:
+        create_fixture(path, **fixture_config)
+        conf = mainmodule.parse_args([path] + options)
+        if conf.seed is None:
+            conf.seed = "SEED"
+        runs = [run_once(path, conf) for _ in range(bench.repeat)]
+    finally:
+        if bench.fixture is None:
+            # The caches are kept outside of the install, keyed on its path, so they go separately.
+            _remove_caches(path)
+            shutil.rmtree(path)
+
+    phases = {}
+    for name in runs[0]:
+        values = sorted(run[name] for run in runs)
+        phases[name] = {"min": values[0], "median": values[len(values) // 2], "runs": [run[name] for run in runs]}
+        print("%-28s min %8.2f ms   median %8.2f ms" % (name, values[0] * 1000, values[len(values) // 2] * 1000))
+    with open(bench.output, "wt") as f:
+        json.dump({
+            "commit": _git_commit(),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "fixture": fixture_config,
+            "options": options,
+            "repeat": bench.repeat,
+            "phases": phases,
+        }, f, indent=1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,16 +1,261 @@
-import zipfile
 import os
 import zlib
 import struct
 import xml.etree.ElementTree as ET
 import re
-from typing import Optional
+import functools
+import pickle
+import json
+import copy
+import bisect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from impak import Impak, cache_filename
+from typing import Optional, Tuple, Iterator, Callable, Dict, List, Iterable, Union, NamedTuple
+
+
+# Bump this whenever the preprocessing in Bundle.load changes, so old caches get rebuilt.
+CACHE_VERSION = 2
+# Lists the files we extracted into the game directory, so clean knows what to remove.
+MANIFEST_NAME = "randomizer_manifest.json"
+PATCH_VERSION = 1
+
+
+def read_cache(filename: str, fingerprint: tuple) -> Optional[dict]:
+    try:
+        with open(filename, "rb") as f:
+            version, cached_fingerprint, files = pickle.load(f)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    if version != CACHE_VERSION or cached_fingerprint != fingerprint:
+        return None
+    return files
+
+
+def write_cache(filename: str, fingerprint: tuple, files: dict) -> None:
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", "wb") as f:
+            pickle.dump((CACHE_VERSION, fingerprint, files), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + ".tmp", filename)
+    except OSError:
+        pass  # Not being able to cache is not fatal, we just parse again next time.
+
+
+class CommentStripper:
+    """Removes xml comments and the surrounding whitespace from data that is fed in chunks.
+
+    The result is the same as repeatedly cutting the first comment out of the whole file,
+    including how nested and unterminated comments are handled, but it is done in a single pass.
+    """
+    OPEN = b"<!--"
+    CLOSE = b"-->"
+
+    def __init__(self):
+        # The undecided text is self.__head followed by self.__tail[self.__pos:]. Kept spans are copied into the
+        # head and comments are cut by skipping over the tail, so no cut has to move the rest of the data.
+        self.__head = bytearray()
+        self.__tail = b""
+        self.__pos = 0
+        self.__opens = []
+        self.__scan_open = 0
+        self.__scan_close = 0
+        self.__started = False
+        self.__whitespace = b""
+
+    def feed(self, data: bytes) -> bytes:
+        self.__tail = self.__tail[self.__pos:] + data
+        self.__pos = 0
+        self.__process()
+        # Removing a comment can glue the bytes in front of it into a new comment start, which can
+        # cascade backwards, so hold on to any trailing "<!-" characters before the undecided part.
+        keep = min(self.__opens[0] if self.__opens else self.__len(), self.__scan_open)
+        while keep > 0 and self.__at(keep - 1) in b"<!-":
+            keep -= 1
+        if keep <= 0:
+            return b""
+        result = self.__take(keep)
+        self.__opens = [n - keep for n in self.__opens]
+        self.__scan_open -= keep
+        self.__scan_close = max(0, self.__scan_close - keep)
+        return self.__output(result)
+
+    def close(self) -> bytes:
+        # Whatever is left is either plain data or an unterminated comment, which we leave alone.
+        return self.__output(self.__take(self.__len()))
+
+    def __process(self) -> None:
+        opens = self.__opens
+        while True:
+            if not opens:
+                start = self.__find(self.OPEN, self.__scan_open)
+                if start < 0:
+                    self.__scan_open = max(self.__scan_open, self.__len() - 3)
+                    return
+                opens.append(start)
+                self.__scan_open = start + 4
+                continue
+            end = self.__find(self.CLOSE, max(self.__scan_close, opens[0] + 4))
+            if len(opens) == 1:
+                # A second comment start before the end means we remove the inner comment only.
+                next = self.__find(self.OPEN, self.__scan_open, end + 3 if end >= 0 else self.__len())
+                if next >= 0:
+                    opens.append(next)
+                else:
+                    self.__scan_open = max(self.__scan_open, end if end >= 0 else self.__len() - 3)
+            if end < 0:
+                self.__scan_close = max(self.__scan_close, self.__len() - 2)
+                return
+            start = opens[1] if len(opens) > 1 and opens[1] < end else opens[0]
+            self.__cut(start, end + 3)
+            del opens[1 if start != opens[0] else 0:]
+            self.__scan_open = self.__scan_close = max(start - 3, 0)
+
+    def __len(self) -> int:
+        return len(self.__head) + len(self.__tail) - self.__pos
+
+    def __at(self, index: int) -> int:
+        if index < len(self.__head):
+            return self.__head[index]
+        return self.__tail[self.__pos + index - len(self.__head)]
+
+    def __find(self, sub: bytes, start: int, end: Optional[int] = None) -> int:
+        head_size = len(self.__head)
+        if end is None:
+            end = self.__len()
+        if start < head_size:
+            # Scanning restarts just before the last cut, so this only looks at the last few bytes of the head.
+            window = (bytes(self.__head[start:]) + self.__tail[self.__pos:self.__pos + len(sub) - 1])[:max(0, end - start)]
+            index = window.find(sub)
+            if index >= 0:
+                return start + index
+            start = head_size
+        if end <= start:
+            return -1
+        index = self.__tail.find(sub, self.__pos + start - head_size, self.__pos + end - head_size)
+        return index - self.__pos + head_size if index >= 0 else -1
+
+    def __cut(self, start: int, stop: int) -> None:
+        head_size = len(self.__head)
+        if start >= head_size:
+            self.__head += memoryview(self.__tail)[self.__pos:self.__pos + start - head_size]
+        elif stop < head_size:
+            del self.__head[start:stop]
+            return
+        else:
+            del self.__head[start:]
+        self.__pos += stop - head_size
+
+    def __take(self, count: int) -> bytes:
+        # Removes and returns the first count bytes of the undecided text.
+        head_size = len(self.__head)
+        if count <= head_size:
+            result = bytes(self.__head[:count])
+            del self.__head[:count]
+            return result
+        result = bytes(self.__head) + self.__tail[self.__pos:self.__pos + count - head_size]
+        self.__head.clear()
+        self.__pos += count - head_size
+        return result
+
+    def __output(self, data: bytes) -> bytes:
+        if not self.__started:
+            data = data.lstrip()
+            if not data:
+                return b""
+            self.__started = True
+        stripped = data.rstrip()
+        if not stripped:
+            self.__whitespace += data
+            return b""
+        result = self.__whitespace + stripped
+        self.__whitespace = data[len(stripped):]
+        return result
+
+
+class QueryStep(NamedTuple):
+    tag: str
+    # (key, value) pairs, attributes must equal the value and child elements must have the value as text.
+    attributes: Tuple[Tuple[str, str], ...]
+    texts: Tuple[Tuple[str, str], ...]
+
+    @property
+    def name(self) -> Optional[str]:
+        for key, value in self.texts:
+            if key == "Name":
+                return value
+        return None
+
+    def matches(self, e: ET.Element) -> bool:
+        for key, value in self.attributes:
+            if e.attrib.get(key) != value:
+                return False
+        for key, value in self.texts:
+            child = e.find(key)
+            if child is None or child.text != value:
+                return False
+        return True
+
+
+QUERY_STEP = re.compile(r"([\w.-]+)((?:\[@?[\w.-]+=[^\]]*\])*)(/|$)")
+QUERY_PREDICATE = re.compile(r"\[(@?)([\w.-]+)=([^\]]*)\]")
+
+
+@functools.lru_cache(maxsize=None)
+def compile_query(path: str) -> Tuple[QueryStep, ...]:
+    """Compiles a path like 'Persona[Name=piper]/LevelCategories/Levels[@Type=upgrades]' into its steps.
+
+    Every step selects the child elements with that tag, [Key=value] requires a child element Key with the
+    text value and [@Key=value] requires the attribute Key to be value.
+    """
+    steps = []
+    pos = 0
+    while pos < len(path):
+        match = QUERY_STEP.match(path, pos)
+        if match is None or (match.group(3) == "/" and match.end() == len(path)):
+            raise ValueError("Invalid query %r at %d" % (path, pos))
+        predicates = QUERY_PREDICATE.findall(match.group(2))
+        steps.append(QueryStep(match.group(1),
+                               tuple((key, value) for attribute, key, value in predicates if attribute),
+                               tuple((key, value) for attribute, key, value in predicates if not attribute)))
+        pos = match.end()
+    if not steps:
+        raise ValueError("Empty query")
+    return tuple(steps)
+
+
+class ChildPositions:
+    """The index of every child of an element, kept up to date as children are added and removed, without rescanning."""
+    __slots__ = ("__indices", "__removed", "__next")
+
+    def __init__(self, etree: ET.Element):
+        self.__indices = {child: index for index, child in enumerate(etree)}
+        # The indices of removed children, sorted. Every child after them has moved up by one.
+        self.__removed: List[int] = []
+        self.__next = len(self.__indices)
+
+    def index(self, child: ET.Element) -> int:
+        index = self.__indices[child]
+        return index - bisect.bisect_left(self.__removed, index)
+
+    def add(self, child: ET.Element) -> None:
+        # Children are only ever appended.
+        self.__indices[child] = self.__next
+        self.__next += 1
+
+    def remove(self, child: ET.Element) -> None:
+        bisect.insort(self.__removed, self.__indices.pop(child))
+
+    def replace(self, old: ET.Element, new: ET.Element) -> None:
+        self.__indices[new] = self.__indices.pop(old)
 
 
 class XmlNode:
-    def __init__(self, etree: ET.Element, parent: Optional[ET.Element]):
+    __slots__ = ("__etree", "__parent", "__root")
+
+    def __init__(self, etree: ET.Element, parent: Optional["XmlNode"], root: "XmlRoot"):
         self.__etree = etree
         self.__parent = parent
+        self.__root = root
 
     @property
     def tag(self):
@@ -22,15 +267,20 @@ class XmlNode:
 
     @text.setter
     def text(self, value):
+        self.__changed("text", value)
         self.__etree.text = value
+        if self.__etree.tag == "Name" and self.__parent is not None and self.__parent.__isTopLevel():
+            self.__parent.__nameChanged()
 
-    def __iter__(self):
-        return iter([XmlNode(child, self.__etree) for child in self.__etree])
+    def __iter__(self) -> Iterator["XmlNode"]:
+        # Iterate over a snapshot of the children, so deleting the current node while iterating is fine.
+        for child in self.__etree[:]:
+            yield self.__root._wrap(child, self)
 
     def getByName(self, name):
         for e in self.__etree:
             if e.find("Name").text == name:
-                return XmlNode(e, self.__etree)
+                return self.__root._wrap(e, self)
         return None
 
     def __getitem__(self, key):
@@ -40,16 +290,27 @@ class XmlNode:
         return e.text
 
     def __setitem__(self, key, value):
+        self.__changed("set", key, value)
         e = self.__etree.find(key)
         if e is None:
-            ET.SubElement(self.__etree, key).text = value
+            e = ET.SubElement(self.__etree, key)
+            e.text = value
+            self.__root._childAdded(self.__etree, e)
         else:
+            if self.__root.owned is not None:
+                e = self.__root._wrap(e, self).__own()
             e.text = value
+        if key == "Name" and self.__isTopLevel():
+            self.__nameChanged()
 
     def __delitem__(self, key):
         e = self.__etree.find(key)
         if e is not None:
+            self.__changed("del", key)
             self.__etree.remove(e)
+            self.__root._childRemoved(self.__etree, e)
+            if key == "Name" and self.__isTopLevel():
+                self.__nameChanged()
 
     def subNode(self, tag, **kwargs) -> Optional["XmlNode"]:
         for e in self.__etree.findall(tag):
@@ -58,99 +319,514 @@ class XmlNode:
                 if k not in e.attrib or e.attrib[k] != v:
                     skip = True
             if not skip:
-                return XmlNode(e, self.__etree)
+                return self.__root._wrap(e, self)
         return None
 
+    def subNodes(self, tag) -> Iterator["XmlNode"]:
+        for e in self.__etree.findall(tag):
+            yield self.__root._wrap(e, self)
+
+    def query(self, path: str) -> List["XmlNode"]:
+        """All nodes below this one matching the path, see compile_query.
+
+        Results are cached on the root until the next change to its file.
+        """
+        return list(self._query(compile_query(path)))
+
+    def queryOne(self, path: str) -> Optional["XmlNode"]:
+        result = self._query(compile_query(path))
+        return result[0] if result else None
+
+    def _query(self, steps: Tuple[QueryStep, ...]) -> Tuple["XmlNode", ...]:
+        cache = self.__root.queries
+        key = (self.__etree, steps)
+        result = cache.get(key)
+        if result is None:
+            nodes = [self]
+            for step in steps:
+                nodes = [node.__root._wrap(e, node) for node in nodes for e in node.__etree.findall(step.tag) if step.matches(e)]
+            result = cache[key] = tuple(nodes)
+        return result
+
+    def _matches(self, step: QueryStep) -> bool:
+        return self.__etree.tag == step.tag and step.matches(self.__etree)
+
     def newChild(self, tag) -> "XmlNode":
+        self.__changed("new", tag)
         e = ET.SubElement(self.__etree, tag)
-        return XmlNode(e, self.__etree)
+        self.__root._childAdded(self.__etree, e)
+        return self.__root._wrap(e, self)
 
     def attr(self, key, value=None) -> str:
         if value is None:
             return self.__etree.attrib.get(key)
+        self.__changed("attr", key, value)
         self.__etree.attrib[key] = value
         return value
 
     def delete(self):
-        self.__parent.remove(self.__etree)
+        self.__changed("delete")
+        self.__parent.__etree.remove(self.__etree)
+        self.__root._childRemoved(self.__parent.__etree, self.__etree)
+        self.__root._unwrap(self.__etree)
+        if self.__isTopLevel():
+            self.__nameChanged()
+        elif self.__etree.tag == "Name" and self.__parent.__isTopLevel():
+            self.__parent.__nameChanged()
+
+    def _child(self, index: int) -> "XmlNode":
+        return self.__root._wrap(self.__etree[index], self)
+
+    def __changed(self, operation: str, *args) -> None:
+        # Called before every change, with the name and arguments of the XmlNode operation.
+        root = self.__root
+        root.dirty = True
+        if root.queries:
+            root.queries.clear()
+        if root.journal is not None:
+            root.journal.append([operation, self.__path()] + list(args))
+        if root.owned is not None:
+            (self.__parent if operation == "delete" else self).__own()
+
+    def __own(self) -> ET.Element:
+        # Copy on write for forked roots: the element and its ancestors are copied the first time they change,
+        # the children stay shared with the original until they change themselves.
+        owned = self.__root.owned
+        if owned is None or self.__etree in owned:
+            return self.__etree
+        path = []
+        node = self
+        while node.__etree not in owned:
+            path.append(node)
+            node = node.__parent
+        parent = node.__etree
+        for node in reversed(path):
+            old = node.__etree
+            # A shallow copy keeps the children, but can share the attributes dict, so that gets its own.
+            new = old.__copy__()
+            new.attrib = dict(old.attrib)
+            parent[node.__root._position(parent, old)] = new
+            node.__root._childReplaced(parent, old, new)
+            owned.add(new)
+            node.__root._repoint(old, new)
+            node.__etree = parent = new
+        return parent
+
+    def __path(self) -> List[int]:
+        path = []
+        node = self
+        while node.__parent is not None:
+            path.append(node.__root._position(node.__parent.__etree, node.__etree))
+            node = node.__parent
+        path.reverse()
+        return path
+
+    def __isTopLevel(self) -> bool:
+        return self.__parent is not None and self.__parent.__parent is None
+
+    def __nameChanged(self) -> None:
+        # Top level nodes are indexed on (tag, Name) by the bundle, so let the root know.
+        self.__root._indexChanged(self.__etree.tag)
 
     def __repr__(self):
         return "%s:%s" % (self.__etree.tag, ["%s=%s" % (k, v) for k, v in self.__etree.attrib.items()])
 
 
 class XmlRoot(XmlNode):
-    def __init__(self, storage_path, data):
+    __slots__ = ("__storage_path", "__etree", "tags", "dirty", "journal", "queries", "owned", "__listeners", "__nodes", "__positions")
+
+    def __init__(self, storage_path, etree: ET.Element):
         self.__storage_path = storage_path
-        self.__etree = ET.fromstring(data)
-        super().__init__(self.__etree, None)
+        self.__etree = etree
+        # The tags of the top level children, so the bundle can skip files that have nothing of interest.
+        self.tags = {child.tag for child in etree}
+        # Set by every change made through an XmlNode, only dirty files need to be written on save.
+        self.dirty = False
+        # When not None, every change is recorded as [operation, path of child indices, arguments...].
+        self.journal: Optional[List[list]] = None
+        # Results of XmlNode.query on (element, compiled path), emptied by every change.
+        self.queries: Dict[Tuple[ET.Element, Tuple[QueryStep, ...]], Tuple[XmlNode, ...]] = {}
+        # For a fork, the elements that belong to it, all others are shared with the root it was forked from.
+        self.owned: Optional[set] = None
+        self.__listeners = []
+        # Every element gets a single wrapper, so walking the tree again does not allocate new ones.
+        self.__nodes: Dict[ET.Element, XmlNode] = {}
+        # Child positions of the elements that needed one, for journal paths and copy on write.
+        self.__positions: Dict[ET.Element, ChildPositions] = {}
+        super().__init__(self.__etree, None, self)
+
+    def newChild(self, tag) -> XmlNode:
+        self.tags.add(tag)
+        self._indexChanged(tag)
+        return super().newChild(tag)
+
+    def __setitem__(self, key, value):
+        # Adds a top level node when there is none with this tag yet.
+        self.tags.add(key)
+        self._indexChanged(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        # Removes a top level node, which the bundle may have indexed.
+        self._indexChanged(key)
+        super().__delitem__(key)
+
+    def addIndexListener(self, callback: Callable[[str], None]) -> None:
+        self.__listeners.append(callback)
 
-    def save(self):
+    def _indexChanged(self, tag: str) -> None:
+        for callback in self.__listeners:
+            callback(tag)
+
+    def _wrap(self, etree: ET.Element, parent: XmlNode) -> XmlNode:
+        node = self.__nodes.get(etree)
+        if node is None:
+            node = self.__nodes[etree] = XmlNode(etree, parent, self)
+        return node
+
+    def _unwrap(self, etree: ET.Element) -> None:
+        self.__nodes.pop(etree, None)
+
+    def _repoint(self, old: ET.Element, new: ET.Element) -> None:
+        node = self.__nodes.pop(old, None)
+        if node is not None:
+            self.__nodes[new] = node
+        # A shallow copy has the same children.
+        positions = self.__positions.pop(old, None)
+        if positions is not None:
+            self.__positions[new] = positions
+
+    def _position(self, parent: ET.Element, child: ET.Element) -> int:
+        positions = self.__positions.get(parent)
+        if positions is None:
+            positions = self.__positions[parent] = ChildPositions(parent)
+        return positions.index(child)
+
+    def _childAdded(self, parent: ET.Element, child: ET.Element) -> None:
+        if parent in self.__positions:
+            self.__positions[parent].add(child)
+
+    def _childRemoved(self, parent: ET.Element, child: ET.Element) -> None:
+        if parent in self.__positions:
+            self.__positions[parent].remove(child)
+
+    def _childReplaced(self, parent: ET.Element, old: ET.Element, new: ET.Element) -> None:
+        if parent in self.__positions:
+            self.__positions[parent].replace(old, new)
+
+    def apply(self, journal: List[list]) -> None:
+        """Replays a journal recorded on an unmodified copy of this file."""
+        for operation, path, *args in journal:
+            node = self
+            try:
+                for index in path:
+                    node = node._child(index)
+            except (IndexError, TypeError):
+                raise ValueError("Journal path %s does not exist in %s" % (path, self.__storage_path))
+            if operation == "text":
+                node.text = args[0]
+            elif operation == "set":
+                node[args[0]] = args[1]
+            elif operation == "del":
+                del node[args[0]]
+            elif operation == "attr":
+                node.attr(args[0], args[1])
+            elif operation == "new":
+                node.newChild(args[0])
+            elif operation == "delete":
+                node.delete()
+            else:
+                raise ValueError("Unknown journal operation: %s" % (operation))
+
+    def copy(self) -> "XmlRoot":
+        return XmlRoot(self.__storage_path, copy.deepcopy(self.__etree))
+
+    def fork(self) -> "XmlRoot":
+        """A copy that shares all elements below the top level with this root, until they are changed through the fork.
+
+        Changes to this root would show up in its forks, so it must not be changed anymore.
+        """
+        etree = ET.Element(self.__etree.tag, self.__etree.attrib)
+        etree.text = self.__etree.text
+        etree.tail = self.__etree.tail
+        etree.extend(self.__etree)
+        result = XmlRoot(self.__storage_path, etree)
+        result.owned = {etree}
+        return result
+
+    def save(self, storage_path: Optional[str] = None):
+        if storage_path is None:
+            storage_path = self.__storage_path
+        # For a fork this also indents the elements it shares, which is harmless: their whitespace only
+        # depends on their depth and children, and those are the same in every fork.
         ET.indent(self.__etree)
-        os.makedirs(os.path.dirname(self.__storage_path), exist_ok=True)
-        open(self.__storage_path, "wb").write(ET.tostring(self.__etree))
+        os.makedirs(os.path.dirname(storage_path), exist_ok=True)
+        with open(storage_path, "wb") as f:
+            ET.ElementTree(self.__etree).write(f)
 
 
 class CSVFile:
+    """A language table: the size of the data, followed by zlib compressed rows of tab separated values keyed by the first.
+
+    Edits are kept until save, which streams the original through and looks up the key of each row until every edit is placed.
+    The whole table is only decompressed when get needs to look up a row.
+    """
+    CHUNK_SIZE = 65536
+
     def __init__(self, storage_path):
         self.__storage_path = storage_path
-        cdata = open(storage_path, "rb").read()
-        self.__data = zlib.decompress(cdata[4:])
-        assert struct.unpack("<I", cdata[:4])[0] == len(self.__data)
-        if not os.path.exists(storage_path + ".backup"):
-            open(storage_path + ".backup", "wb").write(cdata)
+        self.__rows: Optional[List[bytes]] = None
+        self.__index: Optional[Dict[bytes, int]] = None
+        self.__changes: Dict[bytes, bytes] = {}
+        # Every edit ever made, for patches.
+        self.__edits: Dict[str, str] = {}
 
-    def save(self) -> None:
-        cdata = struct.pack("<I", len(self.__data)) + zlib.compress(self.__data, level=9)
-        open(self.__storage_path, "wb").write(cdata)
+    def copy(self) -> "CSVFile":
+        result = CSVFile.__new__(CSVFile)
+        result.__storage_path = self.__storage_path
+        # The rows are never changed, so they can be shared.
+        result.__rows = self.__rows
+        result.__index = self.__index
+        result.__changes = dict(self.__changes)
+        result.__edits = dict(self.__edits)
+        return result
 
-    def set(self, key: str, value: str) -> None:
+    def save(self, storage_path: Optional[str] = None, level: int = zlib.Z_BEST_COMPRESSION) -> None:
+        if not self.__changes:
+            return
+        target = storage_path if storage_path is not None else self.__storage_path
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Written next to the target first, a table without any of the edited keys is left alone.
+        changes = dict(self.__changes)
+        compressor = zlib.compressobj(level)
+        size = 0
+        with open(target + ".tmp", "wb") as f:
+            f.write(struct.pack("<I", 0))  # The size is only known at the end.
+            for data in self.__splice(self.__read(), changes):
+                size += len(data)
+                f.write(compressor.compress(data))
+            f.write(compressor.flush())
+            f.seek(0)
+            f.write(struct.pack("<I", size))
+        if len(changes) == len(self.__changes):
+            os.remove(target + ".tmp")
+            return
+        if storage_path is None and not os.path.exists(target + ".backup"):
+            os.rename(target, target + ".backup")
+        os.replace(target + ".tmp", target)
+
+    @property
+    def changed(self) -> bool:
+        """True if save may write this file, it does when one of the edited keys has a row."""
+        return bool(self.__changes)
+
+    def get(self, key: str) -> Optional[str]:
         key = key.encode("utf-8")
-        value = value.encode("utf-8")
-        parts = self.__data.split(b"\n")
-        for idx, part in enumerate(parts):
-            values = part.split(b"\t")
-            if values[0] == key:
-                values[1] = value
-                part = b"\t".join(values)
-                parts[idx] = part
-                self.__data = b"\n".join(parts)
-                return
+        if self.__index is None:
+            self.__load()
+        if key not in self.__index:
+            return None
+        if key in self.__changes:
+            return self.__changes[key].decode("utf-8")
+        values = self.__rows[self.__index[key]].split(b"\t")
+        return values[1].decode("utf-8") if len(values) > 1 else None
+
+    def set(self, key: str, value: str) -> None:
+        """Sets the second value of the row of key, keys without a row are left out when saving."""
+        self.__changes[key.encode("utf-8")] = value.encode("utf-8")
+        self.__edits[key] = value
+
+    def setMany(self, values: Dict[str, str]) -> None:
+        for key, value in values.items():
+            self.set(key, value)
+
+    def edits(self) -> Dict[str, str]:
+        return dict(self.__edits)
+
+    def __load(self) -> None:
+        self.__rows = b"".join(self.__read()).split(b"\n")
+        # key -> row number, the first row wins if a key is listed twice.
+        self.__index = {}
+        for idx, row in enumerate(self.__rows):
+            self.__index.setdefault(row.split(b"\t", 1)[0], idx)
+
+    def __read(self) -> Iterator[bytes]:
+        # If there is a backup, the file itself was written by an earlier run and the backup is the original.
+        source = self.__storage_path + ".backup"
+        if not os.path.exists(source):
+            source = self.__storage_path
+        decompressor = zlib.decompressobj()
+        total = 0
+        with open(source, "rb") as f:
+            size = struct.unpack("<I", f.read(4))[0]
+            while True:
+                cdata = f.read(self.CHUNK_SIZE)
+                data = decompressor.decompress(cdata) if cdata else decompressor.flush()
+                total += len(data)
+                if data:
+                    yield data
+                if not cdata:
+                    break
+        if total != size:
+            raise ValueError("Bad size for %s" % (source))
+
+    def __splice(self, chunks: Iterator[bytes], changes: Dict[bytes, bytes]) -> Iterator[bytes]:
+        # Edits are removed from changes as their rows are found.
+        pending = b""
+        for chunk in chunks:
+            if not changes:
+                # Every edited row was found, the rest is copied as is.
+                yield pending + chunk
+                pending = b""
+                continue
+            rows = (pending + chunk).split(b"\n")
+            pending = rows.pop()
+            if rows:
+                yield b"\n".join([self.__spliceRow(row, changes) for row in rows]) + b"\n"
+        yield self.__spliceRow(pending, changes) if changes else pending
+
+    @staticmethod
+    def __spliceRow(row: bytes, changes: Dict[bytes, bytes]) -> bytes:
+        # One dict lookup per row, the first row with a key gets the edit.
+        key = row.split(b"\t", 1)[0]
+        if key not in changes:
+            return row
+        values = row.split(b"\t")
+        values[1:2] = [changes.pop(key)]
+        return b"\t".join(values)
 
 
 class Bundle:
     def __init__(self, main_path):
         self.__main_path = main_path
         self.__xml_files = {}
+        self.__raw_files = {}
+        self.__tags = {}
+        # (tag, Name) lookup for getNode, built per tag on first use. Files are searched in load order,
+        # so the first node found wins: "Bundle" over "DLC/dlc01", same as a linear search would give.
+        self.__index: Dict[str, Dict[str, XmlNode]] = {}
         self.__csv_files = {}
+        self.__languages: Optional[List[str]] = None
+        # Set on copies, files are copied (or forked) from the pristine bundle the first time they are used.
+        self.__pristine: Optional[Bundle] = None
+        self.__fork = False
+        self.__journal = False
+        # bundle name -> fingerprint of its impak, as used for the cache.
+        self.__fingerprints: Dict[str, tuple] = {}
 
-    def load(self, bundle_name) -> bool:
+    def copy(self) -> "Bundle":
+        """Returns a bundle with the same files, which can be changed without affecting this one."""
+        result = Bundle(self.__main_path)
+        result.__tags = dict(self.__tags)
+        result.__pristine = self
+        result.__fingerprints = self.__fingerprints
+        return result
+
+    def fork(self) -> "Bundle":
+        """Like copy, but the files share their elements with this bundle until they are changed.
+
+        A fork only costs memory for what gets changed. This bundle must not be changed anymore.
+        """
+        result = self.copy()
+        result.__fork = True
+        return result
+
+    def load(self, bundle_name, workers: Optional[int] = None) -> bool:
+        """Loads the xml files of an impak. Without a cache, workers > 1 preprocesses the files in that many processes."""
         zipfilename = os.path.join(self.__main_path, bundle_name, "data01.impak")
         if not os.path.exists(zipfilename):
             return False
-        z = zipfile.ZipFile(zipfilename, "r")
-        for file in z.namelist():
-            if file.endswith(".xml") or file.endswith(".ge"):
-                data = z.read(file)
-                # We need to fix some xml parsing issues.
-                # First, strip out all comments, as those mess up the parser sometimes.
-                while data.find(b'<!--') >= 0:
-                    start = data.find(b'<!--')
-                    next = data.find(b'<!--', start+4)
-                    end = data.find(b'-->', start+4)
-                    if end < 0:
-                        break
-                    if 0 <= next < end:
-                        start = next
-                    data = data[:start] + data[end+3:]
-                # Next we need to remove the leading spaces
-                data = data.strip()
-                node = XmlRoot(os.path.join(self.__main_path, bundle_name, file), data)
-                self.__xml_files[os.path.join(bundle_name, file)] = node
+        with Impak(zipfilename) as z:
+            fingerprint = self.__fingerprints[bundle_name] = z.fingerprint
+            files = read_cache(cache_filename(zipfilename, ".cache"), fingerprint)
+            if files is None and workers is not None and workers > 1:
+                files = ingest_parallel(zipfilename, [file for file in z.namelist() if file.endswith(".xml") or file.endswith(".ge")], workers)
+                write_cache(cache_filename(zipfilename, ".cache"), fingerprint, files)
+            if files is None:
+                files = {}
+                for file in z.namelist():
+                    if file.endswith(".xml") or file.endswith(".ge"):
+                        data, etree = self._ingest(z, file)
+                        root = self.__addRoot(os.path.join(bundle_name, file), etree)
+                        files[file] = (frozenset(root.tags), data)
+                write_cache(cache_filename(zipfilename, ".cache"), fingerprint, files)
+            else:
+                # Parsing is deferred until a file is actually needed, most runs only touch a few of them.
+                for file, (tags, data) in files.items():
+                    self.__raw_files[os.path.join(bundle_name, file)] = data
+                    self.__tags[os.path.join(bundle_name, file)] = tags
+        self.__index.clear()
         return True
 
+    @staticmethod
+    def _ingest(z: Impak, file: str) -> Tuple[bytes, ET.Element]:
+        # Comments mess up the parser sometimes, so strip them while streaming the member into the parser.
+        stripper = CommentStripper()
+        parser = ET.XMLParser()
+        chunks = []
+        with z.open(file) as f:
+            while chunk := f.read():
+                chunk = stripper.feed(chunk)
+                parser.feed(chunk)
+                chunks.append(chunk)
+        chunk = stripper.close()
+        parser.feed(chunk)
+        chunks.append(chunk)
+        return b"".join(chunks), parser.close()
+
+    @staticmethod
+    def _parse(filename: str, data: bytes) -> ET.Element:
+        try:
+            return ET.fromstring(data)
+        except ET.ParseError as e:
+            raise ValueError("Failed to parse %s: %s" % (filename, e)) from e
+
+    def __getRoot(self, filename: str) -> XmlRoot:
+        root = self.__xml_files.get(filename)
+        if root is None:
+            if filename in self.__raw_files:
+                root = self.__addRoot(filename, self._parse(filename, self.__raw_files.pop(filename)))
+            else:
+                pristine = self.__pristine.__getRoot(filename)
+                root = self.__addRoot(filename, pristine.fork() if self.__fork else pristine.copy())
+        return root
+
+    def __addRoot(self, filename: str, root: Union[XmlRoot, ET.Element]) -> XmlRoot:
+        if not isinstance(root, XmlRoot):
+            root = XmlRoot(os.path.join(self.__main_path, filename), root)
+        root.addIndexListener(self.__indexChanged)
+        if self.__journal:
+            root.journal = []
+        self.__xml_files[filename] = root
+        self.__tags[filename] = root.tags
+        return root
+
+    def __indexChanged(self, tag: str) -> None:
+        self.__index.pop(tag, None)
+
+    def __getRoots(self, tag) -> Iterator[XmlRoot]:
+        for filename, tags in self.__tags.items():
+            if tag in tags:
+                yield self.__getRoot(filename)
+
+    def hasManifest(self) -> bool:
+        return self.__readManifest() is not None
+
     def clean(self) -> None:
         # Clean up old extracted files.
-        for filename in self.__xml_files.keys():
+        manifest = self.__readManifest()
+        if manifest is not None:
+            # The manifest lists exactly what we wrote, so there is no need to search the whole install.
+            for filename in manifest["files"]:
+                if os.path.exists(os.path.join(self.__main_path, filename)):
+                    os.remove(os.path.join(self.__main_path, filename))
+            for filename in manifest["backups"]:
+                if os.path.exists(os.path.join(self.__main_path, filename + ".backup")):
+                    os.replace(os.path.join(self.__main_path, filename + ".backup"), os.path.join(self.__main_path, filename))
+            os.remove(self.__manifestPath())
+            return
+        # Older versions did not write a manifest and extracted every file.
+        for filename in self.__tags.keys():
             if os.path.exists(os.path.join(self.__main_path, filename)):
                 os.remove(os.path.join(self.__main_path, filename))
         for base_path, directories, files in os.walk(self.__main_path):
@@ -160,26 +836,178 @@ class Bundle:
                     os.unlink(filename)
                     os.rename(filename + ".backup", filename)
 
-    def save(self) -> None:
-        for item in self.__xml_files.values():
-            item.save()
-        for item in self.__csv_files.values():
-            item.save()
+    def restore(self, filenames: Iterable[str]) -> None:
+        """Undoes the writes of an earlier save to the given files, named like in the manifest."""
+        manifest = self.__readManifest() or {"files": [], "backups": []}
+        for filename in filenames:
+            path = os.path.join(self.__main_path, filename)
+            if filename in manifest["backups"]:
+                if os.path.exists(path + ".backup"):
+                    os.replace(path + ".backup", path)
+            elif filename in manifest["files"]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def save(self, out_path: Optional[str] = None, max_workers: int = 4, unchanged: Iterable[str] = (),
+             compression: int = zlib.Z_BEST_COMPRESSION) -> None:
+        """Writes the changed files into the game directory, or into out_path with the same layout.
+
+        Files in unchanged, named like in the manifest, are known to be on disk as they would be written and are skipped.
+        The language tables are compressed with the given zlib level, lower is faster but bigger.
+        """
+        unchanged = set(unchanged)
+        # Files that were never changed are left alone, the game keeps reading those from the impak.
+        dirty = {filename: root for filename, root in self.__xml_files.items() if root.dirty and filename not in unchanged}
+        if out_path is None:
+            # Record what we are about to write first, so clean can find it even if saving fails halfway.
+            backups = [os.path.join("Bundle", filename) for filename, item in self.__csv_files.items() if item.changed]
+            self.__writeManifest(dirty.keys(), backups)
+            storage_paths = [None] * len(dirty)
+        else:
+            storage_paths = [os.path.join(out_path, filename) for filename in dirty]
+        # zlib releases the GIL, so the language tables are (de)compressed in parallel as well.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(XmlRoot.save, root, storage_path) for root, storage_path in zip(dirty.values(), storage_paths)]
+            for filename, item in self.__csv_files.items():
+                if os.path.join("Bundle", filename) not in unchanged:
+                    futures.append(executor.submit(item.save, None if out_path is None else os.path.join(out_path, "Bundle", filename), compression))
+            for future in futures:
+                future.result()
+
+    def getFingerprints(self) -> Dict[str, tuple]:
+        return dict(self.__fingerprints)
+
+    def readState(self) -> Optional[dict]:
+        """The state stored with writeState since the last clean, if any."""
+        manifest = self.__readManifest()
+        return manifest.get("state") if manifest is not None else None
+
+    def writeState(self, state: dict) -> None:
+        self.__writeManifest([], [], state)
 
-    def getNodes(self, tag) -> XmlNode:
+    def recordJournal(self) -> None:
+        """Start recording every change, so getPatch can describe them. Must be called before making changes."""
+        assert not any(root.dirty for root in self.__xml_files.values())
+        self.__journal = True
         for root in self.__xml_files.values():
-            for child in root:
-                if child.tag == tag:
-                    yield child
+            root.journal = []
+
+    def getPatch(self) -> dict:
+        return {
+            "version": PATCH_VERSION,
+            "files": {filename: root.journal for filename, root in self.__xml_files.items() if root.dirty},
+            "csv": {filename: csv.edits() for filename, csv in self.__csv_files.items() if csv.edits()},
+        }
+
+    def applyPatch(self, patch: dict) -> None:
+        """Applies a patch from getPatch on an unmodified bundle. Only the patched files get parsed."""
+        if patch.get("version") != PATCH_VERSION:
+            raise ValueError("Unsupported patch version: %s" % (patch.get("version")))
+        for filename, journal in patch["files"].items():
+            if filename not in self.__tags:
+                raise ValueError("Patch changes %s, which is not in this game" % (filename))
+            self.__getRoot(filename).apply(journal)
+        for filename, edits in patch["csv"].items():
+            if not os.path.exists(os.path.join(self.__main_path, "Bundle", filename)):
+                raise ValueError("Patch changes %s, which is not in this game" % (filename))
+            self.getCSV(filename).setMany(edits)
+
+    def __manifestPath(self) -> str:
+        return os.path.join(self.__main_path, MANIFEST_NAME)
+
+    def __readManifest(self) -> Optional[Dict[str, List[str]]]:
+        try:
+            with open(self.__manifestPath(), "rt") as f:
+                manifest = json.load(f)
+            return {"files": manifest["files"], "backups": manifest["backups"], "state": manifest.get("state")}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def __writeManifest(self, filenames: Iterable[str], backups: Iterable[str], state: Optional[dict] = None) -> None:
+        manifest = self.__readManifest() or {"files": [], "backups": [], "state": None}
+        with open(self.__manifestPath(), "wt") as f:
+            json.dump({
+                "files": sorted(set(manifest["files"]) | set(filenames)),
+                "backups": sorted(set(manifest["backups"]) | set(backups)),
+                "state": state if state is not None else manifest["state"],
+            }, f, indent=1)
+
+    def getNodes(self, tag) -> Iterator[XmlNode]:
+        for root in self.__getRoots(tag):
+            yield from root.subNodes(tag)
 
     def getNode(self, tag, name) -> XmlNode:
-        for root in self.__xml_files.values():
-            for child in root:
-                if child.tag == tag and child["Name"] == name:
-                    return child
-        return None
+        index = self.__index.get(tag)
+        if index is None:
+            index = self.__index[tag] = self._buildIndex(tag)
+        return index.get(name)
+
+    def query(self, path: str) -> List[XmlNode]:
+        """All nodes matching the path, whose first step is a top level tag, see compile_query.
+
+        When the first step has a Name predicate it names the node getNode returns, not every node with that name.
+        """
+        steps = compile_query(path)
+        first = steps[0]
+        if first.name is not None:
+            node = self.getNode(first.tag, first.name)
+            starts = [node] if node is not None and node._matches(first) else []
+        else:
+            starts = [node for node in self.getNodes(first.tag) if node._matches(first)]
+        if len(steps) == 1:
+            return starts
+        return [result for node in starts for result in node._query(steps[1:])]
+
+    def queryOne(self, path: str) -> Optional[XmlNode]:
+        result = self.query(path)
+        return result[0] if result else None
+
+    def _buildIndex(self, tag) -> Dict[str, XmlNode]:
+        index = {}
+        for node in self.getNodes(tag):
+            index.setdefault(node["Name"], node)
+        return index
+
+    def getLanguageFiles(self) -> List[str]:
+        """The filenames of every language table, for getCSV."""
+        if self.__pristine is not None:
+            return self.__pristine.getLanguageFiles()
+        if self.__languages is None:
+            try:
+                files = os.listdir(os.path.join(self.__main_path, "Bundle", "Language"))
+            except FileNotFoundError:
+                files = []
+            self.__languages = sorted("Language/" + file for file in files if file.endswith(".csv.z"))
+        return self.__languages
 
     def getCSV(self, filename) -> CSVFile:
         if filename not in self.__csv_files:
-            self.__csv_files[filename] = CSVFile(os.path.join(self.__main_path, "Bundle", filename))
+            if self.__pristine is not None:
+                self.__csv_files[filename] = self.__pristine.getCSV(filename).copy()
+            else:
+                self.__csv_files[filename] = CSVFile(os.path.join(self.__main_path, "Bundle", filename))
         return self.__csv_files[filename]
+
+
+def _ingest_members(zipfilename: str, files: List[str]) -> List[Tuple[frozenset, bytes]]:
+    with Impak(zipfilename) as z:
+        result = []
+        for file in files:
+            data, etree = Bundle._ingest(z, file)
+            result.append((frozenset(child.tag for child in etree), data))
+        return result
+
+
+def ingest_parallel(zipfilename: str, files: List[str], workers: int) -> Dict[str, Tuple[frozenset, bytes]]:
+    """Strips the comments from the given impak members in a process pool, the result is in the same form as the cache.
+
+    The members are handed out in small consecutive batches and collected in order, so the result is in archive order
+    no matter which process finished first.
+    """
+    batch_size = max(1, len(files) // (workers * 4))
+    batches = [files[n:n + batch_size] for n in range(0, len(files), batch_size)]
+    result = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch, entries in zip(batches, executor.map(_ingest_members, [zipfilename] * len(batches), batches)):
+            result.update(zip(batch, entries))
+    return result
@@ -0,0 +1,201 @@
+"""Keeps the parsed game loaded in worker processes and randomizes seeds on request, see the --serve option of main.
+
+The protocol is one JSON object per line in both directions:
+  {"command": "randomize", "seed": "abc", "options": {"charweapon": "basic", "stripquests": true}, "out": "/path", "wait": true}
+    -> {"ok": true, "job": 1, "state": "done", "latency": 0.21}, without "wait" the reply is sent when the job is queued.
+  {"command": "status", "job": 1} -> {"ok": true, "job": 1, "state": "queued" | "done" | "failed", ...}
+  {"command": "health"} -> {"ok": true, "queue": 0, "completed": 10, "failed": 0, "reloads": 0, "latency": {...}}
+Errors are replied as {"ok": false, "error": "..."}.
+"""
+import main as mainmodule
+import batch
+import collections
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional, Tuple
+
+
+# Finished jobs are remembered for status requests, up to this many.
+MAX_JOBS = 10000
+# Options a randomize request can set, every pass option except the seed which has its own field.
+OPTIONS = [option for options in mainmodule.PASS_OPTIONS.values() for option in options if option != "seed"]
+
+
+class Service:
+    def __init__(self, install_path: str, jobs: Optional[int] = None):
+        self.__install_path = install_path
+        self.__jobs = jobs
+        self.__lock = threading.Lock()
+        self.__pool: Optional[ProcessPoolExecutor] = None
+        self.__impak_key = None
+        self.__records = collections.OrderedDict()
+        self.__next_job = 1
+        self.__queued = 0
+        self.__counts = collections.Counter()
+        self.__latencies = collections.deque(maxlen=1000)
+        self.__getPool()
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.shutdown()
+                self.__pool = None
+
+    def __getPool(self) -> ProcessPoolExecutor:
+        # Called with the lock held. When the game was updated the workers are replaced, so new jobs see the new files.
+        key = mainmodule.impak_stats(self.__install_path)
+        if self.__pool is None or key != self.__impak_key:
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=False)
+                self.__counts["reloads"] += 1
+            self.__pool = ProcessPoolExecutor(max_workers=self.__jobs, initializer=batch._init_worker, initargs=(self.__install_path,))
+            self.__impak_key = key
+            # Start every worker now, so the game is parsed before the first jobs come in.
+            for _ in range(self.__jobs or os.cpu_count() or 1):
+                self.__pool.submit(os.getpid)
+        return self.__pool
+
+    def submit(self, seed: str, options: dict, out_path: str) -> Tuple[int, threading.Event]:
+        """Queues a job, the event is set once its record is final."""
+        args = [self.__install_path, "--seed=%s" % (seed)]
+        for key, value in options.items():
+            if key not in OPTIONS:
+                raise ValueError("Unknown option: %s" % (key))
+            if value is True:
+                args.append("--%s" % (key))
+            elif value is not False:
+                args.append("--%s=%s" % (key, value))
+        try:
+            conf = mainmodule.parse_args(args)
+        except SystemExit:
+            raise ValueError("Invalid options: %s" % (json.dumps(options)))
+        with self.__lock:
+            job = self.__next_job
+            self.__next_job += 1
+            record = self.__records[job] = {"job": job, "seed": seed, "state": "queued", "submitted": time.time()}
+            while len(self.__records) > MAX_JOBS:
+                self.__records.popitem(last=False)
+            self.__queued += 1
+            start = time.perf_counter()
+            future = self.__getPool().submit(batch._randomize_seed, conf, out_path)
+        finished = threading.Event()
+        future.add_done_callback(lambda f: self.__finished(record, f, time.perf_counter() - start, finished))
+        return job, finished
+
+    def __finished(self, record: dict, future: Future, latency: float, finished: threading.Event) -> None:
+        with self.__lock:
+            self.__queued -= 1
+            record["latency"] = latency
+            if future.exception() is None:
+                record["state"] = "done"
+                self.__counts["completed"] += 1
+                self.__latencies.append(latency)
+            else:
+                record["state"] = "failed"
+                record["error"] = str(future.exception())
+                self.__counts["failed"] += 1
+        finished.set()
+
+    def status(self, job: int) -> Optional[dict]:
+        with self.__lock:
+            record = self.__records.get(job)
+            return dict(record) if record is not None else None
+
+    def health(self) -> dict:
+        with self.__lock:
+            latencies = sorted(self.__latencies)
+            return {
+                "queue": self.__queued,
+                "completed": self.__counts["completed"],
+                "failed": self.__counts["failed"],
+                "reloads": self.__counts["reloads"],
+                "latency": {
+                    "count": len(latencies),
+                    "mean": sum(latencies) / len(latencies) if latencies else None,
+                    "median": latencies[len(latencies) // 2] if latencies else None,
+                    "max": latencies[-1] if latencies else None,
+                },
+            }
+
+    def handle(self, request: dict) -> dict:
+        command = request.get("command")
+        if command == "randomize":
+            if not isinstance(request.get("seed"), str) or not isinstance(request.get("out"), str):
+                raise ValueError("randomize needs a seed and an out directory")
+            job, finished = self.submit(request["seed"], request.get("options", {}), request["out"])
+            if request.get("wait"):
+                # Not the future, it wakes its waiters before running the callback that updates the record.
+                finished.wait()
+            return self.status(job)
+        if command == "status":
+            record = self.status(request.get("job"))
+            if record is None:
+                raise ValueError("Unknown job: %s" % (request.get("job")))
+            return record
+        if command == "health":
+            return self.health()
+        raise ValueError("Unknown command: %s" % (command))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = self.server.service.handle(json.loads(line))
+                reply["ok"] = True
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socket, "AF_UNIX"):
+    class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def _is_socket(path: str) -> bool:
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+def serve(install_path: str, address: str, jobs: Optional[int] = None) -> None:
+    """Serves requests on address, which is host:port or the path of a unix socket, until interrupted or terminated."""
+    host, _, port = address.rpartition(":")
+    if port.isdigit():
+        server = TCPServer((host or "127.0.0.1", int(port)), RequestHandler)
+    else:
+        if _is_socket(address):
+            os.remove(address)  # Left behind by an earlier run.
+        elif os.path.exists(address):
+            raise ValueError("%s exists and is not a socket" % (address))
+        server = UnixServer(address, RequestHandler)
+    server.service = Service(install_path, jobs)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving on %s" % (address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+        if not port.isdigit() and _is_socket(address):
+            os.remove(address)
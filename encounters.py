@@ -0,0 +1,39 @@
+from bundle import Bundle, XmlNode
+from typing import Optional, Dict, List
+
+
+class Encounters:
+    """Resolves the effective MissionType of encounters by following their Template chain.
+
+    Every template is resolved only once, assuming MissionType and Template are not changed afterwards.
+    """
+    def __init__(self, bundle: Bundle):
+        self.__bundle = bundle
+        self.__mission_types: Dict[Optional[str], Optional[str]] = {}
+
+    def getMissionType(self, encounter: XmlNode) -> Optional[str]:
+        mission_type = encounter["MissionType"]
+        if mission_type is None:
+            mission_type = self.__templateMissionType(encounter["Template"])
+        if mission_type is None:
+            # DLC overrides existing shops so we need to get the template from the original shop.
+            mission_type = self.__templateMissionType(encounter["Name"])
+        return mission_type
+
+    def __templateMissionType(self, name: Optional[str]) -> Optional[str]:
+        chain: List[Optional[str]] = []
+        while name not in self.__mission_types:
+            if name in chain:
+                raise ValueError("Encounter template cycle: %s" % (" -> ".join(map(str, chain + [name]))))
+            chain.append(name)
+            node = self.__bundle.getNode("Encounter", name)
+            if node is None:
+                self.__mission_types[name] = None
+            elif node["MissionType"] is not None:
+                self.__mission_types[name] = node["MissionType"]
+            else:
+                name = node["Template"]
+        mission_type = self.__mission_types[name]
+        for name in chain:
+            self.__mission_types[name] = mission_type
+        return mission_type
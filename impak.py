@@ -0,0 +1,173 @@
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import sys
+import zipfile
+import zlib
+from typing import List, NamedTuple, Optional
+
+
+# Bump this whenever the layout of the .index file changes.
+INDEX_VERSION = 1
+# The end of central directory record, it has to be within the last 64KB + 22 bytes of a zip file.
+EOCD_SIGNATURE = b"PK\x05\x06"
+EOCD_SIZE = 22
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+LOCAL_SIGNATURE = b"PK\x03\x04"
+
+
+def cache_filename(filename: str, extension: str) -> str:
+    """Where to cache what is derived from filename: in the cache directory of the user, not in the game install."""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    path = os.path.abspath(filename)
+    # Every install has its own Bundle/data01.impak, so the name includes a hash of the full path.
+    name = "%s-%s%s" % (hashlib.sha1(path.encode("utf-8")).hexdigest()[:16], os.path.basename(path), extension)
+    return os.path.join(base, "SteamWorldHeistRandomizer", name)
+
+
+class Entry(NamedTuple):
+    name: str
+    header_offset: int
+    compress_type: int
+    compress_size: int
+    file_size: int
+    crc: int
+    flag_bits: int
+
+
+class Impak:
+    """Read only access to an impak, which is a zip archive, through a memory map of the whole file.
+
+    The central directory is parsed once and stored in a .index file in the user cache directory, so opening
+    it again only needs to check that the end of central directory record is still the same.
+    Use it as a context manager, so the map and the file are closed when done.
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, filename: str):
+        self.__file = open(filename, "rb")
+        self.__map = None
+        try:
+            stat = os.fstat(self.__file.fileno())
+            self.__stat = (stat.st_size, stat.st_mtime_ns)
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+            eocd_offset = self.__map.rfind(EOCD_SIGNATURE, max(0, len(self.__map) - 65536 - EOCD_SIZE))
+            eocd = self.__map[eocd_offset:eocd_offset + EOCD_SIZE] if eocd_offset >= 0 else b""
+            self.__entries = self.__readIndex(cache_filename(filename, ".index"), eocd)
+            if self.__entries is None:
+                with zipfile.ZipFile(self.__file) as z:
+                    self.__entries = [Entry(info.filename, info.header_offset, info.compress_type, info.compress_size,
+                                            info.file_size, info.CRC, info.flag_bits) for info in z.infolist()]
+                self.__writeIndex(cache_filename(filename, ".index"), eocd)
+        except BaseException:
+            self.close()
+            raise
+        self.__by_name = {entry.name: entry for entry in self.__entries}
+
+    def __enter__(self) -> "Impak":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.__map is not None:
+            self.__map.close()
+        self.__file.close()
+
+    def namelist(self) -> List[str]:
+        return [entry.name for entry in self.__entries]
+
+    @property
+    def fingerprint(self) -> tuple:
+        # The central directory holds the CRC of every member, so hashing it catches content changes
+        # without having to read the whole (large) archive.
+        crc = 0
+        for entry in self.__entries:
+            crc = zlib.crc32(struct.pack("<II", entry.crc, entry.file_size) + entry.name.encode("utf-8"), crc)
+        return self.__stat + (crc,)
+
+    def open(self, name: str) -> "MemberReader":
+        entry = self.__by_name[name]
+        header = LOCAL_HEADER.unpack_from(self.__map, entry.header_offset)
+        if header[0] != LOCAL_SIGNATURE:
+            raise ValueError("Bad local header for %s" % (name))
+        if entry.flag_bits & 0x1:
+            raise ValueError("Encrypted member %s is not supported" % (name))
+        start = entry.header_offset + LOCAL_HEADER.size + header[10] + header[11]
+        return MemberReader(entry, memoryview(self.__map)[start:start + entry.compress_size])
+
+    def __readIndex(self, filename: str, eocd: bytes) -> Optional[List[Entry]]:
+        try:
+            with open(filename, "rb") as f:
+                version, stat, cached_eocd, entries = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if version != INDEX_VERSION or stat != self.__stat or cached_eocd != eocd:
+            return None
+        return [Entry(*entry) for entry in entries]
+
+    def __writeIndex(self, filename: str, eocd: bytes) -> None:
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename + ".tmp", "wb") as f:
+                pickle.dump((INDEX_VERSION, self.__stat, eocd, [tuple(entry) for entry in self.__entries]), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(filename + ".tmp", filename)
+        except OSError:
+            pass  # Not being able to cache is not fatal, we just read the central directory again next time.
+
+
+class MemberReader:
+    """Inflates a member straight from the memory map, use it as a context manager to release the map."""
+    def __init__(self, entry: Entry, data: memoryview):
+        self.__entry = entry
+        self.__data = data
+        self.__pos = 0
+        self.__crc = 0
+        self.__size = 0
+        if entry.compress_type == zipfile.ZIP_DEFLATED:
+            self.__decompressor = zlib.decompressobj(-15)
+        elif entry.compress_type == zipfile.ZIP_STORED:
+            self.__decompressor = None
+        else:
+            data.release()
+            raise ValueError("Unsupported compression %d for %s" % (entry.compress_type, entry.name))
+
+    def __enter__(self) -> "MemberReader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.__data.release()
+
+    def read(self, size: int = Impak.CHUNK_SIZE) -> bytes:
+        """Returns the next part of the member, decompressed from about size bytes of input, b"" at the end."""
+        while self.__pos < len(self.__data):
+            chunk = self.__data[self.__pos:self.__pos + size]
+            self.__pos += len(chunk)
+            if self.__decompressor is None:
+                result = bytes(chunk)
+            else:
+                result = self.__decompressor.decompress(chunk)
+                if self.__pos == len(self.__data):
+                    result += self.__decompressor.flush()
+            chunk.release()
+            if result or self.__pos == len(self.__data):
+                return self.__check(result)
+        return b""
+
+    def __check(self, data: bytes) -> bytes:
+        self.__crc = zlib.crc32(data, self.__crc)
+        self.__size += len(data)
+        if self.__pos == len(self.__data) and (self.__crc != self.__entry.crc or self.__size != self.__entry.file_size):
+            raise ValueError("Bad CRC or size for %s" % (self.__entry.name))
+        return data
@@ -0,0 +1,113 @@
+import main as mainmodule
+from bundle import Bundle, PATCH_VERSION
+import argparse
+import hashlib
+import json
+import os
+import random
+from typing import Callable, Dict, List, Optional
+
+
+# Bump this whenever a pass changes what it does, so changes recorded by an older version are not replayed.
+STATE_VERSION = 1
+
+
+def _hash(value) -> str:
+    return hashlib.sha1(json.dumps(value).encode("utf-8")).hexdigest()
+
+
+def _snapshot(bundle: Bundle) -> dict:
+    patch = bundle.getPatch()
+    return {"files": {filename: len(journal) for filename, journal in patch["files"].items()}, "csv": patch["csv"]}
+
+
+def _changes_since(bundle: Bundle, snapshot: dict) -> dict:
+    # The journals only grow, so the changes of a pass are what was added to them since its snapshot.
+    patch = bundle.getPatch()
+    files = {}
+    for filename, journal in patch["files"].items():
+        if len(journal) > snapshot["files"].get(filename, 0):
+            files[filename] = journal[snapshot["files"].get(filename, 0):]
+    csv = {}
+    for filename, edits in patch["csv"].items():
+        before = snapshot["csv"].get(filename, {})
+        changed = {key: value for key, value in edits.items() if before.get(key) != value}
+        if changed:
+            csv[filename] = changed
+    return {"version": PATCH_VERSION, "files": files, "csv": csv}
+
+
+def _base_key(bundle: Bundle, has_dlc: bool) -> str:
+    return _hash([STATE_VERSION, has_dlc, sorted(bundle.getFingerprints().items())])
+
+
+def _stat(main_path: str, filename: str) -> Optional[List[int]]:
+    try:
+        stat = os.stat(os.path.join(main_path, filename))
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def randomize(bundle: Bundle, conf: argparse.Namespace, has_dlc: bool, previous: Optional[dict], *,
+              on_pass: Optional[Callable[[str], None]] = None) -> dict:
+    """Runs the passes like main.randomize, returning a state that lets a later run reuse them.
+
+    Each pass gets a key from the key of the pass before it, its options and the state of the random generator.
+    As long as the keys match those in previous, the recorded changes are applied instead of running the pass.
+    The bundle must be recording its journal.
+    """
+    rnd = random.Random(conf.seed)
+    key = _base_key(bundle, has_dlc)
+    state = {"base": key, "passes": []}
+    previous_passes = previous["passes"] if previous is not None and previous.get("base") == key else []
+    data = None
+    for index, (name, func) in enumerate(mainmodule.PASSES):
+        key = _hash([key, name, [getattr(conf, option) for option in mainmodule.PASS_OPTIONS[name]], rnd.getstate()])
+        if on_pass is not None:
+            on_pass(name)
+        snapshot = _snapshot(bundle)
+        recorded = previous_passes[index] if index < len(previous_passes) else None
+        if recorded is not None and recorded["key"] == key:
+            bundle.applyPatch(recorded["patch"])
+            version, internal, gauss = recorded["random"]
+            rnd.setstate((version, tuple(internal), gauss))
+        else:
+            # Everything after a changed pass sees a different random generator, so nothing further can be reused.
+            previous_passes = []
+            if data is None:
+                data = mainmodule.load_game_data(bundle, has_dlc)
+            func(bundle, conf, rnd, data)
+        state["passes"].append({"name": name, "key": key, "patch": _changes_since(bundle, snapshot), "random": rnd.getstate()})
+    return state
+
+
+def run(conf: argparse.Namespace, bundle: Bundle, has_dlc: bool, *,
+        on_pass: Optional[Callable[[str], None]] = None, mark: Callable[[str], None] = lambda phase: None) -> None:
+    """Randomizes the install, only rewriting the files whose contents differ from what the previous run wrote."""
+    previous = bundle.readState()
+    if previous is None or previous.get("base") != _base_key(bundle, has_dlc):
+        # Not written by this version of the randomizer or for this version of the game, start over.
+        bundle.clean()
+        previous = None
+    bundle.recordJournal()
+    state = randomize(bundle, conf, has_dlc, previous, on_pass=on_pass)
+
+    mark("save")
+    # A file is the original with the changes of every pass applied in order, so those changes identify its contents.
+    # Files are named like in the manifest.
+    changes: Dict[str, list] = {}
+    for record in state["passes"]:
+        for filename, journal in record["patch"]["files"].items():
+            changes.setdefault(filename, []).append(journal)
+        for filename, edits in record["patch"]["csv"].items():
+            # The compression level is part of what gets written.
+            changes.setdefault(os.path.join("Bundle", filename), [conf.compression]).append(edits)
+    files = {filename: _hash(file_changes) for filename, file_changes in changes.items()}
+    written = previous["files"] if previous is not None else {}
+    unchanged = [filename for filename, contents in files.items()
+                 if filename in written and written[filename]["contents"] == contents and written[filename]["stat"] == _stat(conf.install_path, filename)]
+    bundle.restore([filename for filename in written if filename not in files])
+    bundle.save(unchanged=unchanged, compression=conf.compression)
+    state["files"] = {filename: {"contents": contents, "stat": _stat(conf.install_path, filename)} for filename, contents in files.items()}
+    bundle.writeState(state)
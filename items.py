@@ -1,7 +1,7 @@
 from bundle import Bundle
 import itertools
 import collections
-from typing import Optional, List
+from typing import Optional, Sequence, Dict, Tuple
 
 
 Item = collections.namedtuple("Item", ["name", "tier", "rtype"])
@@ -15,24 +15,35 @@ class Items:
             if rarity:
                 self.__items.append(Item(item["Name"], int(rarity.attr("Tier")), rarity.attr("Type")))
 
-    def find(self, name: str) -> Optional[Item]:
+        # Precompute the candidate pools, in the same order as self.__items so that rnd.choice on
+        # a pool picks the same item for a seed as filtering the full list would.
+        self.__by_name: Dict[str, Item] = {}
+        by_type = collections.defaultdict(list)
+        by_tier = collections.defaultdict(list)
         for item in self.__items:
-            if item[0] == name:
-                return item
-        return None
-
-    def listAccordingToMathingConfig(self, item, config) -> List[Item]:
-        result = []
-        for i in self.__items:
-            if config == "type":
-                if i.tier != item.tier or i.rtype != item.rtype:
-                    continue
-            elif config == "tier":
-                if i.tier != item.tier:
-                    continue
-            else:
-                diff = int(config)
-                if abs(i.tier - item.tier) > diff:
-                    continue
-            result.append(i)
+            self.__by_name.setdefault(item.name, item)
+            by_type[(item.tier, item.rtype)].append(item)
+            by_tier[item.tier].append(item)
+        self.__by_type: Dict[Tuple[int, str], Tuple[Item, ...]] = {k: tuple(v) for k, v in by_type.items()}
+        self.__by_tier: Dict[int, Tuple[Item, ...]] = {k: tuple(v) for k, v in by_tier.items()}
+        self.__by_window: Dict[Tuple[int, str], Tuple[Item, ...]] = {}
+        for tier in self.__by_tier:
+            for config in ("1", "2"):
+                self.__window(tier, config)
+
+    def find(self, name: str) -> Optional[Item]:
+        return self.__by_name.get(name)
+
+    def listAccordingToMathingConfig(self, item, config) -> Sequence[Item]:
+        if config == "type":
+            return self.__by_type.get((item.tier, item.rtype), ())
+        if config == "tier":
+            return self.__by_tier.get(item.tier, ())
+        return self.__window(item.tier, config)
+
+    def __window(self, tier: int, config: str) -> Tuple[Item, ...]:
+        result = self.__by_window.get((tier, config))
+        if result is None:
+            diff = int(config)
+            result = self.__by_window[(tier, config)] = tuple(i for i in self.__items if abs(i.tier - tier) <= diff)
         return result
@@ -3,7 +3,11 @@ import random
 import sys
 import os
 import argparse
+import json
 from items import Items
+from encounters import Encounters
+from perks import place_chains
+from typing import Tuple, Optional, Callable, NamedTuple
 
 
 def find_steam():
@@ -31,90 +35,94 @@ def find_game():
     return None
 
 
-def main(args):
-    parser = argparse.ArgumentParser()
-    parser.add_argument("install_path", nargs="?")
-    parser.add_argument("--clean", action="store_true")
-    parser.add_argument("--stripquests", action="store_true")
-    parser.add_argument("--charweapon", choices=["default", "basic", "wild"], default="default")
-    parser.add_argument("--charlevelup", choices=["default", "basic", "wild"], default="default")
-    parser.add_argument("--epicswag", choices=["default", "type", "tier", "1", "2"], default="default")
-    parser.add_argument("--shop", choices=["default", "type", "tier", "1", "2"], default="default")
-    parser.add_argument("--seed")
-    conf = parser.parse_args(args)
-    print(conf)
+def impak_stats(install_path: str) -> list:
+    """The size and modification time of the impaks, these only change when the game is updated."""
+    result = []
+    for bundle_name in ("Bundle", "DLC/dlc01"):
+        try:
+            stat = os.stat(os.path.join(install_path, bundle_name, "data01.impak"))
+            result.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            result.append(None)
+    return result
 
-    if conf.install_path is None:
-        conf.install_path = find_game()
-    if conf.install_path is None:
-        print("Install path not supplied and not found from search, cannot continue")
-        exit(1)
-    if conf.seed is None:
-        conf.seed = "SEED"
-    rnd = random.Random(conf.seed)
 
-    game_path = find_game()
-    bundle = Bundle(game_path)
-    bundle.load("Bundle")
-    has_dlc = bundle.load("DLC/dlc01")
-    bundle.clean()
-    if conf.clean:  # Our work is done, do nothing else.
+def load_bundle(install_path: str, workers: Optional[int] = None) -> Tuple[Bundle, bool]:
+    bundle = Bundle(install_path)
+    bundle.load("Bundle", workers)
+    has_dlc = bundle.load("DLC/dlc01", workers)
+    return bundle, has_dlc
+
+
+CAST = ["piper", "sea_brass", "ivanski", "sally_bolt", "valentine", "beatrix", "dora", "payroll", "billy_gill"]
+WEAPON_PERKS = ["handgun", "marksman", "assault", "heavy"]
+WEAPON_PERK_SETS = [
+    ("handgun",),
+    ("handgun", "marksman"),
+    ("handgun", "assault"),
+    ("handgun", "heavy"),
+]
+MAIN_PERKS = [
+    ("damaging_shot", "damaging_shot_lower_cd", "damaging_shot_upgrade", "damaging_shot_upgrade_2"),
+    ("leader", "area_heal", "leader_inc_area", "leader_upgrade"), # area_heal_more_uses
+    ("soaker", "wrath_of_the_sea", "wrath_of_the_sea_02"),
+    ("double_shot", "double_shot_reduced_cooldown"),
+    ("abs_of_steel", "abs_of_steel_taunt", "abs_of_steel_more_uses"),
+    ("killer", "mad_dog", "mad_dog_more_uses"),
+    ("berserker", "berserker_upgraded"),
+    ("camper", "camper_upgrade", "camper_upgrade_02"),
+    ("piercing_shot", "piercing_shot_reduced_cooldown"),
+    ("beatrix_launcher", "beatrix_launcher_uses", "beatrix_launcher_damage"),
+    ("beatrix_explosion_resistance",),
+    ("flanker", "flanker_crit", "backstabber", "back_breaker"),
+    ("boot_boost", "boot_boost_reduced_cooldown"),
+    ("run_n_gun", "run_n_gun_reduced_cooldown"),
+    ("double_melee", "double_melee_reduced_cooldown"),
+    ("mend", ),
+    ("guts", ),
+    ("war_cry",),
+    ("soot_screen",),
+    ("reduce_sway",),
+    ("loose_gun",),
+    ("sprint_after_kill",),
+    ("dora_stun_gun",),
+]
+DLC_CAST = ["ghost"]
+DLC_MAIN_PERKS = [("ghost_charge_beam", "ghost_charge_self_heal", "ghost_charge_beam_upgrade_1", "ghost_charge_self_heal_free", "ghost_charge_beam_upgrade_2", "ghost_charge_beam_upgrade_3", "ghost_charge_self_heal_upgrade")]
+FILLER_PERKS = ["health", "health2", "speed", "melee_damage", "melee_damage2"]
+
+
+class GameData(NamedTuple):
+    """Read only information about the unmodified game, can be shared by any number of randomize calls."""
+    has_dlc: bool
+    items: Items
+    encounters: Encounters
+
+
+def load_game_data(bundle: Bundle, has_dlc: bool) -> GameData:
+    return GameData(has_dlc, Items(bundle), Encounters(bundle))
+
+
+def strip_quests(bundle: Bundle, conf: argparse.Namespace, rnd: random.Random, data: GameData) -> None:
+    if not conf.stripquests:
         return
+    # Remove all the quests, this generates a more streamlined experience without
+    # too much story to get in the way of the action.
+    for quest in bundle.getNodes("Quest"):
+        # tutorial_start is needed or else the game crashes on startup
+        if quest["Name"] not in {"MAIN", "tutorial_start"}:
+            quest.delete()
+
+    # Remove all the conversations before/after missions, to speed up the game.
+    for encounter in bundle.getNodes("Encounter"):
+        del encounter["StartConversation"]
+        del encounter["EndConversation"]
 
-    CAST = ["piper", "sea_brass", "ivanski", "sally_bolt", "valentine", "beatrix", "dora", "payroll", "billy_gill"]
-    if has_dlc:
-        CAST += ["ghost"]
-    WEAPON_PERKS = ["handgun", "marksman", "assault", "heavy"]
-    WEAPON_PERK_SETS = [
-        ("handgun",),
-        ("handgun", "marksman"),
-        ("handgun", "assault"),
-        ("handgun", "heavy"),
-    ]
-    MAIN_PERKS = [
-        ("damaging_shot", "damaging_shot_lower_cd", "damaging_shot_upgrade", "damaging_shot_upgrade_2"),
-        ("leader", "area_heal", "leader_inc_area", "leader_upgrade"), # area_heal_more_uses
-        ("soaker", "wrath_of_the_sea", "wrath_of_the_sea_02"),
-        ("double_shot", "double_shot_reduced_cooldown"),
-        ("abs_of_steel", "abs_of_steel_taunt", "abs_of_steel_more_uses"),
-        ("killer", "mad_dog", "mad_dog_more_uses"),
-        ("berserker", "berserker_upgraded"),
-        ("camper", "camper_upgrade", "camper_upgrade_02"),
-        ("piercing_shot", "piercing_shot_reduced_cooldown"),
-        ("beatrix_launcher", "beatrix_launcher_uses", "beatrix_launcher_damage"),
-        ("beatrix_explosion_resistance",),
-        ("flanker", "flanker_crit", "backstabber", "back_breaker"),
-        ("boot_boost", "boot_boost_reduced_cooldown"),
-        ("run_n_gun", "run_n_gun_reduced_cooldown"),
-        ("double_melee", "double_melee_reduced_cooldown"),
-        ("mend", ),
-        ("guts", ),
-        ("war_cry",),
-        ("soot_screen",),
-        ("reduce_sway",),
-        ("loose_gun",),
-        ("sprint_after_kill",),
-        ("dora_stun_gun",),
-    ]
-    if has_dlc:
-        MAIN_PERKS += [("ghost_charge_beam", "ghost_charge_self_heal", "ghost_charge_beam_upgrade_1", "ghost_charge_self_heal_free", "ghost_charge_beam_upgrade_2", "ghost_charge_beam_upgrade_3", "ghost_charge_self_heal_upgrade")]
-    FILLER_PERKS = ["health", "health2", "speed", "melee_damage", "melee_damage2"]
-    ITEMS = Items(bundle)
-
-    if conf.stripquests:
-        # Remove all the quests, this generates a more streamlined experience without
-        # too much story to get in the way of the action.
-        for quest in bundle.getNodes("Quest"):
-            # tutorial_start is needed or else the game crashes on startup
-            if quest["Name"] not in {"MAIN", "tutorial_start"}:
-                quest.delete()
-
-        # Remove all the conversations before/after missions, to speed up the game.
-        for encounter in bundle.getNodes("Encounter"):
-            del encounter["StartConversation"]
-            del encounter["EndConversation"]
-    for cast in CAST:
-        starting = bundle.getNode("Persona", cast).subNode("LevelCategories").subNode("Levels", Type="starting")
+
+def randomize_cast(bundle: Bundle, conf: argparse.Namespace, rnd: random.Random, data: GameData) -> None:
+    main_perks = MAIN_PERKS + (DLC_MAIN_PERKS if data.has_dlc else [])
+    for cast in CAST + (DLC_CAST if data.has_dlc else []):
+        starting = bundle.queryOne("Persona[Name=%s]/LevelCategories/Levels[@Type=starting]" % (cast))
         for level in starting:
             if level.attr("Perk") in WEAPON_PERKS and conf.charweapon != "default":
                 level.delete()
@@ -130,27 +138,9 @@ def main(args):
                 starting.newChild("Level").attr("Perk", perk)
 
         if conf.charlevelup == "basic":
-            upgrade_perks = [None] * 10
-            done_perks = set()
-            while len([p for p in upgrade_perks if p is not None]) < 5:
-                perk = rnd.choice(MAIN_PERKS)
-                if perk in done_perks:
-                    continue
-                done_perks.add(perk)
-                index_list = [n for n in range(10)]
-                rnd.shuffle(index_list)
-                index_list = index_list[:len(perk)]
-                index_list.sort()
-                skip = False
-                for idx in index_list:
-                    if upgrade_perks[idx] is not None:
-                        skip = True
-                if skip:
-                    continue
-                for idx, p in zip(index_list, perk):
-                    upgrade_perks[idx] = p
+            upgrade_perks = place_chains(rnd, main_perks)
             upgrade_perks = [perk if perk is not None else rnd.choice(FILLER_PERKS) for perk in upgrade_perks]
-            upgrades = bundle.getNode("Persona", cast).subNode("LevelCategories").subNode("Levels", Type="upgrades")
+            upgrades = bundle.queryOne("Persona[Name=%s]/LevelCategories/Levels[@Type=upgrades]" % (cast))
             for upgrade in upgrades:
                 upgrade.delete()
             for perk in upgrade_perks:
@@ -159,45 +149,190 @@ def main(args):
         if conf.charlevelup == "wild":
             upgrade_perks = []
             while len(upgrade_perks) < 10:
-                perk = rnd.choice(MAIN_PERKS + [(f,) for f in FILLER_PERKS])
+                perk = rnd.choice(main_perks + [(f,) for f in FILLER_PERKS])
                 n = 0
                 while n < len(perk) and perk[n] in upgrade_perks:
                     n += 1
                 if n < len(perk):
                     upgrade_perks.append(perk[n])
-            upgrades = bundle.getNode("Persona", cast).subNode("LevelCategories").subNode("Levels", Type="upgrades")
+            upgrades = bundle.queryOne("Persona[Name=%s]/LevelCategories/Levels[@Type=upgrades]" % (cast))
             for upgrade in upgrades:
                 upgrade.delete()
             for perk in upgrade_perks:
                 upgrades.newChild("Level").attr("Perk", perk)
 
+
+def randomize_loot(bundle: Bundle, conf: argparse.Namespace, rnd: random.Random, data: GameData) -> None:
     for encounter in bundle.getNodes("Encounter"):
         master_loot = encounter.subNode("MasterLoot")
         if master_loot:
-            node = encounter
-            while node is not None and node["MissionType"] is None:
-                node = bundle.getNode("Encounter", node["Template"])
-            if node is None:  # DLC overrides existing shops so we need to get the template from the original shop.
-                node = bundle.getNode("Encounter", encounter["Name"])
-                while node is not None and node["MissionType"] is None:
-                    node = bundle.getNode("Encounter", node["Template"])
-
-            if node["MissionType"] == "heist" and conf.epicswag != "default":  # Mission type is "heist" or "bar", "heist" for battles, "bar" for shops.
+            mission_type = data.encounters.getMissionType(encounter)
+
+            if mission_type == "heist" and conf.epicswag != "default":  # Mission type is "heist" or "bar", "heist" for battles, "bar" for shops.
                 for child in master_loot:
-                    item = ITEMS.find(child.text)
+                    item = data.items.find(child.text)
                     if item:
-                        child.text = rnd.choice(ITEMS.listAccordingToMathingConfig(item, conf.epicswag)).name
+                        child.text = rnd.choice(data.items.listAccordingToMathingConfig(item, conf.epicswag)).name
 
-            if node["MissionType"] == "bar" and conf.shop != "default":  # Mission type is "heist" or "bar", "heist" for battles, "bar" for shops.
+            if mission_type == "bar" and conf.shop != "default":  # Mission type is "heist" or "bar", "heist" for battles, "bar" for shops.
                 for child in master_loot:
-                    item = ITEMS.find(child.text)
+                    item = data.items.find(child.text)
                     if item:
-                        child.text = rnd.choice(ITEMS.listAccordingToMathingConfig(item, conf.shop)).name
+                        child.text = rnd.choice(data.items.listAccordingToMathingConfig(item, conf.shop)).name
+
+
+def write_seed(bundle: Bundle, conf: argparse.Namespace, rnd: random.Random, data: GameData) -> None:
+    for filename in bundle.getLanguageFiles():
+        bundle.getCSV(filename).set("menu_extras", "SEED: %s" % (conf.seed))
 
 
-    bundle.getCSV("Language/en.csv.z").set("menu_extras", "SEED: %s" % (conf.seed))
-    bundle.save()
+# The randomization passes in the order they run, they all share one random generator.
+PASSES = [
+    ("stripquests", strip_quests),
+    ("cast", randomize_cast),
+    ("loot", randomize_loot),
+    ("seed", write_seed),
+]
+# The options each pass reads, see incremental.
+PASS_OPTIONS = {
+    "stripquests": ("stripquests",),
+    "cast": ("charweapon", "charlevelup"),
+    "loot": ("epicswag", "shop"),
+    "seed": ("seed",),
+}
+
+
+def randomize(bundle: Bundle, conf: argparse.Namespace, has_dlc: bool, *,
+              data: Optional[GameData] = None, on_pass: Optional[Callable[[str], None]] = None) -> None:
+    rnd = random.Random(conf.seed)
+    if data is None:
+        data = load_game_data(bundle, has_dlc)
+    for name, func in PASSES:
+        if on_pass is not None:
+            on_pass(name)
+        func(bundle, conf, rnd, data)
+
+
+def parse_args(args) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("install_path", nargs="?")
+    parser.add_argument("--clean", action="store_true")
+    parser.add_argument("--stripquests", action="store_true")
+    parser.add_argument("--charweapon", choices=["default", "basic", "wild"], default="default")
+    parser.add_argument("--charlevelup", choices=["default", "basic", "wild"], default="default")
+    parser.add_argument("--epicswag", choices=["default", "type", "tier", "1", "2"], default="default")
+    parser.add_argument("--shop", choices=["default", "type", "tier", "1", "2"], default="default")
+    parser.add_argument("--seed")
+    parser.add_argument("--batch", metavar="SEEDS_FILE", help="Randomize every seed listed in this file, one per line")
+    parser.add_argument("--out", metavar="PATH", help="Output directory for --batch, gets a sub directory per seed, or report file for --analyze")
+    parser.add_argument("--analyze", metavar="COUNT", type=int, help="Randomize this many seeds in memory and report histograms of the results")
+    parser.add_argument("--serve", metavar="ADDRESS", help="Keep running and randomize seeds requested on host:port or a unix socket path, see daemon.py")
+    parser.add_argument("--jobs", type=int, help="Number of worker processes for --batch, --analyze and --serve, or for parsing the game files when they are not cached yet")
+    parser.add_argument("--compression", metavar="LEVEL", type=int, choices=range(10), default=9,
+                        help="zlib level for the language files, lower writes faster but bigger files")
+    parser.add_argument("--patch", metavar="FILE", help="Write the changes as a patch file instead of into the game")
+    parser.add_argument("--apply", metavar="FILE", help="Apply a patch file made with --patch to the game")
+    parser.add_argument("--timings", metavar="FILE", nargs="?", const="-",
+                        help="Write a JSON report of phase and parse times and hot path counters, to stdout without FILE")
+    parser.add_argument("--profile", metavar="FILE", help="Write cProfile statistics of the run to this file")
+    return parser.parse_args(args)
+
+
+def main(args):
+    conf = parse_args(args)
+    print(conf)
+
+    if conf.install_path is None:
+        conf.install_path = find_game()
+    if conf.install_path is None:
+        print("Install path not supplied and not found from search, cannot continue")
+        exit(1)
+    if conf.seed is None:
+        conf.seed = "SEED"
+
+    if conf.batch is not None:
+        if conf.out is None:
+            print("--batch requires --out")
+            exit(1)
+        import batch
+        seeds = [line.strip() for line in open(conf.batch, "rt") if line.strip()]
+        batch.run(conf, seeds, conf.out, conf.jobs)
+        return
+
+    if conf.serve is not None:
+        import daemon
+        daemon.serve(conf.install_path, conf.serve, conf.jobs)
+        return
+
+    if conf.analyze is not None:
+        if conf.out is None:
+            print("--analyze requires --out")
+            exit(1)
+        import analysis
+        analysis.run(conf, conf.analyze, conf.out, conf.jobs)
+        return
+
+    timings = None
+    if conf.timings is not None:
+        import timings as timingsmodule
+        timings = timingsmodule.Timings()
+        timings.install()
+    profiler = None
+    if conf.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(conf, timings)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(conf.profile)
+        if timings is not None:
+            timings.mark(None)
+            timings.uninstall()
+            timings.write(conf.timings)
+
+
+def run(conf: argparse.Namespace, timings=None) -> None:
+    mark = timings.mark if timings is not None else lambda phase: None
+    on_pass = (lambda name: mark("pass_" + name)) if timings is not None else None
+
+    mark("load")
+    if conf.clean:
+        bundle = Bundle(conf.install_path)
+        if not bundle.hasManifest():
+            # Without a manifest we need to know which files the bundles contain to clean up.
+            bundle = load_bundle(conf.install_path, conf.jobs)[0]
+        mark("clean")
+        bundle.clean()
+        return
+
+    bundle, has_dlc = load_bundle(conf.install_path, conf.jobs)
+    if conf.patch is not None:
+        bundle.recordJournal()
+        mark("game_data")
+        data = load_game_data(bundle, has_dlc)
+        randomize(bundle, conf, has_dlc, data=data, on_pass=on_pass)
+        mark("patch")
+        with open(conf.patch, "wt") as f:
+            json.dump(bundle.getPatch(), f, separators=(",", ":"))
+        return
+
+    if conf.apply is not None:
+        mark("clean")
+        bundle.clean()
+        mark("apply")
+        with open(conf.apply, "rt") as f:
+            bundle.applyPatch(json.load(f))
+        mark("save")
+        bundle.save(compression=conf.compression)
+        return
 
+    # Only redoes the passes, and rewrites the files, that differ from the previous run.
+    import incremental
+    mark("clean")
+    incremental.run(conf, bundle, has_dlc, on_pass=on_pass, mark=mark)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,40 @@
+import random
+from typing import List, Optional, Sequence, Tuple
+
+
+Chain = Tuple[str, ...]
+
+
+def place_chains(rnd: random.Random, chains: Sequence[Chain], *, slots: int = 10, target: int = 5,
+                 required: Sequence[Chain] = ()) -> List[Optional[str]]:
+    """Places perk chains into the level up slots, keeping the perks of each chain in order.
+
+    The required chains are placed first, then chains are added until at least target slots are used.
+    Each step picks a chain with rnd.choice from the chains not used yet that fit in the free slots,
+    in the order given, and then its slots with rnd.sample from the free slots in increasing order.
+    So the layout only depends on the state of rnd and the order of chains, and there is no retrying:
+    at most len(required) + len(chains) steps are taken. When no chain fits anymore, fewer than
+    target slots can be used. Unused slots are None.
+    """
+    layout: List[Optional[str]] = [None] * slots
+    free = list(range(slots))
+
+    def place(chain: Chain) -> None:
+        indices = sorted(rnd.sample(free, len(chain)))
+        for index, perk in zip(indices, chain):
+            layout[index] = perk
+            free.remove(index)
+
+    for chain in required:
+        if len(chain) > len(free):
+            raise ValueError("Required perk chains do not fit in %d slots" % (slots))
+        place(chain)
+    candidates = [chain for chain in chains if chain not in required]
+    while slots - len(free) < target:
+        fitting = [chain for chain in candidates if len(chain) <= len(free)]
+        if not fitting:
+            break
+        chain = rnd.choice(fitting)
+        candidates.remove(chain)
+        place(chain)
+    return layout
@@ -0,0 +1,113 @@
+"""Optional instrumentation for a randomizer run, see the --timings and --profile options of main.
+
+Counters are collected by wrapping the hot methods only while a report is being made, so a
+normal run executes the original, uninstrumented code.
+"""
+import collections
+import functools
+import json
+import sys
+import time
+from typing import Optional
+
+from bundle import Bundle, XmlNode, CSVFile
+from items import Items
+
+
+class Timings:
+    def __init__(self):
+        self.__phases = {}
+        self.__parses = {}
+        self.__counters = collections.Counter()
+        self.__current: Optional[str] = None
+        self.__current_start = 0.0
+        self.__start = time.perf_counter()
+        self.__originals = []
+        self.__indexing = 0
+
+    def mark(self, phase: Optional[str]) -> None:
+        """Ends the current phase and starts the next one, None just ends the current one."""
+        now = time.perf_counter()
+        if self.__current is not None:
+            self.__phases[self.__current] = self.__phases.get(self.__current, 0.0) + now - self.__current_start
+        self.__current = phase
+        self.__current_start = now
+
+    def install(self) -> None:
+        counters = self.__counters
+        timings = self
+
+        def count(name):
+            def decorator(func):
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    counters[name] += 1
+                    return func(*args, **kwargs)
+                return wrapper
+            return decorator
+
+        def timed_parse(func, name_arg):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    timings.__parses[args[name_arg]] = time.perf_counter() - start
+            return staticmethod(wrapper)
+
+        def build_index(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                counters["Bundle.getNode index builds"] += 1
+                timings.__indexing += 1
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    timings.__indexing -= 1
+            return wrapper
+
+        def sub_nodes(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                name = "Bundle.getNode children scanned" if timings.__indexing else "XmlNode.subNodes children scanned"
+                for node in func(*args, **kwargs):
+                    counters[name] += 1
+                    yield node
+            return wrapper
+
+        self.__patch(Bundle, "getNode", count("Bundle.getNode calls"))
+        self.__patch(Bundle, "_buildIndex", build_index)
+        self.__patch(XmlNode, "subNodes", sub_nodes)
+        self.__patch(XmlNode, "__init__", count("XmlNode wrappers created"))
+        self.__patch(Items, "listAccordingToMathingConfig", count("Items.listAccordingToMathingConfig calls"))
+        self.__patch(CSVFile, "set", count("CSVFile.set calls"))
+        self.__patch(Bundle, "_parse", lambda func: timed_parse(func, 0))
+        self.__patch(Bundle, "_ingest", lambda func: timed_parse(func, 1))
+
+    def uninstall(self) -> None:
+        for cls, name, original in reversed(self.__originals):
+            setattr(cls, name, original)
+        self.__originals.clear()
+
+    def __patch(self, cls, name, decorator) -> None:
+        original = cls.__dict__[name]
+        self.__originals.append((cls, name, original))
+        func = original.__func__ if isinstance(original, staticmethod) else original
+        setattr(cls, name, decorator(func))
+
+    def report(self) -> dict:
+        return {
+            "total": time.perf_counter() - self.__start,
+            "phases": dict(self.__phases),
+            "parses": dict(sorted(self.__parses.items(), key=lambda item: -item[1])),
+            "counters": dict(self.__counters),
+        }
+
+    def write(self, filename: str) -> None:
+        if filename == "-":
+            json.dump(self.report(), sys.stdout, indent=1)
+            print()
+        else:
+            with open(filename, "wt") as f:
+                json.dump(self.report(), f, indent=1)
@@ -3,9 +3,42 @@ from tkinter import ttk
 from tkinter import filedialog
 from tkinter import messagebox
 import main as mainmodule
+from bundle import Bundle
 import os
+import queue
 import random
 import base64
+import threading
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Job(threading.Thread):
+    """Runs work(phase) in the background, work calls phase(name) to report progress and allow cancelling."""
+    def __init__(self, work):
+        super().__init__()
+        self.__work = work
+        self.__cancel = threading.Event()
+        self.messages = queue.Queue()
+
+    def cancel(self):
+        self.__cancel.set()
+
+    def phase(self, name):
+        if self.__cancel.is_set():
+            raise Cancelled()
+        self.messages.put(("phase", name))
+
+    def run(self):
+        try:
+            self.__work(self.phase)
+            self.messages.put(("done", None))
+        except Cancelled:
+            self.messages.put(("cancelled", None))
+        except Exception as e:
+            self.messages.put(("error", e))
 
 
 class MainUI:
@@ -19,6 +52,10 @@ class MainUI:
         self.random_seed()
         self.__options = {}
         self.__option_mapping = {}
+        self.__job = None
+        self.__phases = []
+        # (key, bundle, has_dlc, data) of the last loaded install, only used from the job thread.
+        self.__pristine = None
 
         self.__row = 0
 
@@ -70,8 +107,23 @@ Randomize Epic Swag rewards.
 
         subframe = ttk.Frame(self.__frame)
         subframe.grid(column=1, row=self.__row, sticky=(tk.N, tk.W, tk.E, tk.S))
-        ttk.Button(subframe, text="Randomize!", command=self.randomize).grid(column=0, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
-        ttk.Button(subframe, text="Remove randomization", command=self.clean).grid(column=1, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
+        self.__buttons = [
+            ttk.Button(subframe, text="Randomize!", command=self.randomize),
+            ttk.Button(subframe, text="Remove randomization", command=self.clean),
+        ]
+        for column, button in enumerate(self.__buttons):
+            button.grid(column=column, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
+        self.__row += 1
+
+        self.__status = tk.StringVar()
+        self.__progress = ttk.Progressbar(self.__frame, mode="determinate")
+        self.__progress.grid(column=0, row=self.__row, sticky=(tk.N, tk.W, tk.E, tk.S))
+        subframe = ttk.Frame(self.__frame)
+        subframe.grid(column=1, row=self.__row, sticky=(tk.N, tk.W, tk.E, tk.S))
+        ttk.Label(subframe, textvariable=self.__status).grid(column=0, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
+        self.__cancel_button = ttk.Button(subframe, text="Cancel", command=self.cancel, state=tk.DISABLED)
+        self.__cancel_button.grid(column=1, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
+        self.__root.protocol("WM_DELETE_WINDOW", self.close)
 
     def __addOption(self, key, label, options=None, *, default=None, help_text=None):
         if options is not None:
@@ -137,12 +189,90 @@ Randomize Epic Swag rewards.
             if isinstance(value, tk.BooleanVar):
                 if value.get():
                     args.append("--%s" % (key))
-        mainmodule.main(args)
-        messagebox.showinfo("Steamworld Heist Randomizer", "Randomization complete.\nBest start a new save!")
+        conf = mainmodule.parse_args(args)
+        if conf.seed is None:
+            conf.seed = "SEED"
+        phases = ["load", "game_data"] + [name for name, _ in mainmodule.PASSES] + ["save"]
+        self.__start(lambda phase: self.__randomizeJob(conf, phase), phases,
+                     "Randomization complete.\nBest start a new save!")
 
     def clean(self):
-        mainmodule.main([self.__install_path.get(), "--clean"])
-        messagebox.showinfo("Steamworld Heist Randomizer", "Randomization removed,\nvanilla game can be played.")
+        install_path = self.__install_path.get()
+        self.__start(lambda phase: self.__cleanJob(install_path, phase), ["load", "game_data", "clean"],
+                     "Randomization removed,\nvanilla game can be played.")
+
+    def cancel(self):
+        if self.__job is not None:
+            self.__job.cancel()
+            self.__status.set("Cancelling...")
+
+    def close(self):
+        # A job that is saving finishes before the process exits, so the install is never left half written.
+        self.cancel()
+        self.__root.destroy()
+
+    def __start(self, work, phases, done_message):
+        self.__job = Job(work)
+        self.__phases = phases
+        self.__done_message = done_message
+        self.__progress.configure(maximum=len(phases), value=0)
+        for button in self.__buttons:
+            button.configure(state=tk.DISABLED)
+        self.__cancel_button.configure(state=tk.NORMAL)
+        self.__job.start()
+        self.__root.after(50, self.__poll)
+
+    def __poll(self):
+        while True:
+            try:
+                kind, value = self.__job.messages.get_nowait()
+            except queue.Empty:
+                self.__root.after(50, self.__poll)
+                return
+            if kind == "phase":
+                if value in self.__phases:
+                    self.__progress.configure(value=self.__phases.index(value))
+                self.__status.set(value)
+                continue
+            self.__job = None
+            self.__progress.configure(value=0)
+            self.__status.set("")
+            for button in self.__buttons:
+                button.configure(state=tk.NORMAL)
+            self.__cancel_button.configure(state=tk.DISABLED)
+            if kind == "done":
+                messagebox.showinfo("Steamworld Heist Randomizer", self.__done_message)
+            elif kind == "error":
+                messagebox.showerror("Steamworld Heist Randomizer", "Failed: %s" % (value))
+            return
+
+    def __getPristine(self, install_path, phase):
+        # The impak files only change when the game is updated, so the parsed bundle can be reused between runs.
+        key = [install_path] + mainmodule.impak_stats(install_path)
+        if self.__pristine is None or self.__pristine[0] != key:
+            phase("load")
+            bundle, has_dlc = mainmodule.load_bundle(install_path)
+            phase("game_data")
+            self.__pristine = (key, bundle, has_dlc, mainmodule.load_game_data(bundle, has_dlc))
+        return self.__pristine[1:]
+
+    def __randomizeJob(self, conf, phase):
+        pristine, has_dlc, data = self.__getPristine(conf.install_path, phase)
+        bundle = pristine.fork()
+        mainmodule.randomize(bundle, conf, has_dlc, data=data, on_pass=phase)
+        # Only touch the install once randomizing is done, a cancel before this leaves the game as it was.
+        phase("save")
+        bundle.clean()
+        bundle.save(compression=conf.compression)
+
+    def __cleanJob(self, install_path, phase):
+        phase("load")
+        bundle = Bundle(install_path)
+        if not bundle.hasManifest():
+            # Without a manifest we need to know which files the bundles contain to clean up.
+            bundle = self.__getPristine(install_path, phase)[0]
+        phase("clean")
+        bundle.clean()
 
     def browse_install_path(self):
         exename = "Heist"